@@ -0,0 +1,208 @@
+"""Time source shared by every component measuring the progress of
+a race.
+
+Time is read from the monotonic clock of the system so that it never
+jumps when the wall-clock is adjusted (e.g. by NTP on a Raspberry Pi)
+and is counted in integer ticks of a configurable resolution. Ticks
+are only converted to seconds when they are presented, so that drones
+reaching a gate within the same tenth of a second still get ordered.
+
+Clocks also schedule the callbacks that must run after a delay (end of
+the allotted time of a drone, sending of a batch of updates...). The
+virtual clock does not follow the system time at all: it jumps straight
+to the next deadline so that whole races can be simulated in a fraction
+of their real duration.
+"""
+
+
+import heapq
+from itertools import count
+from threading import Lock, Timer
+from time import monotonic_ns, time as wall_time
+
+from .i18n import translations
+
+
+_, _N = translations('utils')
+
+
+NANOSECONDS = 10**9
+
+
+class RaceClock:
+    """Monotonic clock counting time in ticks."""
+
+    def __init__(self, resolution=1000):
+        """Create the clock.
+
+        Parameter:
+          - resolution: amount of ticks per second; must divide one
+            billion (e.g. 10 for tenths, 1000 for milliseconds)
+        """
+        if resolution < 1 or NANOSECONDS % resolution:
+            raise ValueError(_(
+                    'Unsupported clock resolution: {}').format(resolution))
+        self.resolution = resolution
+        self._divisor = NANOSECONDS // resolution
+
+    def now(self):
+        """Return the amount of ticks elapsed since an arbitrary origin."""
+        return monotonic_ns() // self._divisor
+
+    def seconds(self, ticks):
+        """Convert an amount of ticks into seconds."""
+        return ticks / self.resolution
+
+    def ticks(self, seconds):
+        """Convert an amount of seconds into ticks."""
+        return round(seconds * self.resolution)
+
+    def round(self, seconds):
+        """Round an amount of seconds, usually resulting from arithmetic on
+        values returned by `seconds`, to the resolution of the clock.
+        """
+        return self.seconds(self.ticks(seconds))
+
+    def wall(self):
+        """Return the wall-clock time, in seconds since the epoch."""
+        return wall_time()
+
+    def call_later(self, delay, callback, *args):
+        """Schedule a function to be called after some time.
+
+        Parameters:
+          - delay: amount of seconds to wait before calling the function
+          - callback: the function to call
+          - args: positional arguments to call the function with
+
+        Return an object whose `cancel` method prevents the call if it
+        did not happen yet.
+        """
+        timer = Timer(max(delay, 0), callback, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+class _Deadline:
+    """Call scheduled on a virtual clock."""
+
+    __slots__ = ('callback', 'args', 'cancelled')
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Prevent the call if it did not happen yet."""
+        self.cancelled = True
+
+
+class VirtualClock(RaceClock):
+    """Clock whose time only moves forward when asked to. Scheduled
+    callbacks are kept in a queue ordered by deadline and are run by
+    the thread advancing the time, as soon as it reaches them.
+    """
+
+    def __init__(self, resolution=1000, start=0.0):
+        """Create the clock, stopped at its origin.
+
+        Parameters:
+          - resolution: amount of ticks per second; must divide one
+            billion (e.g. 10 for tenths, 1000 for milliseconds)
+          - start: wall-clock time, in seconds since the epoch, that
+            corresponds to the origin of the clock
+        """
+        super().__init__(resolution)
+        self.start = start
+        self._now = 0
+        self._queue = []
+        self._sequence = count()
+        self._lock = Lock()
+
+    def now(self):
+        """Return the amount of ticks elapsed since the origin."""
+        return self._now
+
+    def wall(self):
+        """Return the simulated wall-clock time."""
+        return self.start + self.seconds(self._now)
+
+    def call_later(self, delay, callback, *args):
+        """Schedule a function to be called when the virtual time will
+        have advanced of the given amount of seconds.
+
+        Parameters:
+          - delay: amount of seconds to wait before calling the function
+          - callback: the function to call
+          - args: positional arguments to call the function with
+
+        Return an object whose `cancel` method prevents the call if it
+        did not happen yet.
+        """
+        deadline = _Deadline(callback, args)
+        with self._lock:
+            heapq.heappush(self._queue, (
+                    self._now + max(self.ticks(delay), 0),
+                    next(self._sequence), deadline))
+        return deadline
+
+    def next_deadline(self):
+        """Return the amount of seconds until the next scheduled call,
+        or None if nothing is scheduled.
+        """
+        with self._lock:
+            self._discard_cancelled()
+            if not self._queue:
+                return None
+            return self.seconds(self._queue[0][0] - self._now)
+
+    def _discard_cancelled(self):
+        """Drop cancelled calls from the head of the queue. The lock
+        must be held.
+        """
+        while self._queue and self._queue[0][2].cancelled:
+            heapq.heappop(self._queue)
+
+    def _pop(self, limit):
+        """Remove the next call due at or before the given amount of
+        ticks from the queue and move the time up to its deadline.
+
+        Return the call or None if there is no such call.
+        """
+        with self._lock:
+            self._discard_cancelled()
+            if not self._queue or (
+                    limit is not None and self._queue[0][0] > limit):
+                return None
+            ticks, _, deadline = heapq.heappop(self._queue)
+            self._now = max(self._now, ticks)
+            return deadline
+
+    def advance(self, seconds):
+        """Move the time forward, running every call scheduled in the
+        meantime in the order of their deadlines. Calls scheduled by
+        these callbacks are run as well if they are due.
+
+        Parameter:
+          - seconds: amount of seconds to move the time forward by
+        """
+        limit = self._now + self.ticks(seconds)
+        self._run(limit)
+        with self._lock:
+            self._now = max(self._now, limit)
+
+    def run(self):
+        """Jump from deadline to deadline, running scheduled calls, until
+        nothing is left to run.
+        """
+        self._run(None)
+
+    def _run(self, limit):
+        """Run the scheduled calls up to the given amount of ticks."""
+        while True:
+            deadline = self._pop(limit)
+            if deadline is None:
+                return
+            deadline.callback(*deadline.args)
@@ -1,7 +1,11 @@
-from threading import Timer
+from array import array
+from threading import RLock
+from bisect import bisect_left, insort
+from collections import namedtuple, OrderedDict
 from enum import Enum
 
-from . import rest
+from .publishers import RESTPublisher
+from .splits import Splits
 from .i18n import translations
 
 
@@ -15,180 +19,547 @@ class ConsoleError(Exception):
     pass
 
 
+class FrozenRow(dict):
+    """Read-only copy of the status of a drone at a given version of
+    the leader-board. Being a dict, it can be JSON encoded as is.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError(_('Published drone statuses can not be modified'))
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return FrozenRow, (dict(self),)
+
+
+class Snapshot(namedtuple('Snapshot', 'version running drones')):
+    """Immutable view of the leader-board published after each event
+    processed by a console:
+      - version: number of views published before this one
+      - running: whether or not the race was started and not over yet
+      - drones: tuple of FrozenRow indexed by the 0-based drone number;
+        None for numbers not attending the race
+
+    Rows of drones that did not change are shared between versions.
+    """
+    __slots__ = ()
+
+    @property
+    def leaderboard(self):
+        """Statuses of the drones attending the race."""
+        return [drone for drone in self.drones if drone is not None]
+
+
 class Console:
     """Manage the various informations influencing the progress of a race."""
 
-    def __init__(self, timer, update):
+    def __init__(self, clock, update, track=None, beacons=None, journal=None,
+                 flush_interval=0.05, publisher=None):
         """Initiate the race manager for the lifetime of the application.
 
         Parameters:
-          - timer: function to call when a race is started to get the time
-            elapsed since the beginning of said race
-          - update: function to call when informations about a drone has changed
+          - clock: the RaceClock object providing the time of the races
+            and scheduling timeouts; the time at which a race is started
+            is used as its origin
+          - update: function to call with the statuses of the drones whose
+            informations have changed since its last call
+          - track: name of the track this console manages races for, sent
+            along every message published to the REST API
+          - beacons: range of beacon numbers allowed on this track, if the
+            reader is shared with other tracks
+          - journal: the Journal object recording events of the races so
+            they can be recovered after a crash, if any
+          - flush_interval: amount of seconds during which changes are
+            gathered before being sent as a single batch; 0 to send them
+            after each event
+          - publisher: the BasePublisher object telling the spectators
+            about the progress of the races; messages are sent to the
+            REST API by default
         """
-        # TODO lock to synchronize compute and edit~?
         self.gates = None
         self.scores = None
         self.extra_data = None
         self.rules = None
-        self.timer = timer
-        self.update = update
+        # Rules of the last race setup, kept after the race is over so
+        # that judge edits can still update its time tables
+        self._rules = None
+        self.clock = clock
+        self.subscribers = [update]
+        self.flush_interval = flush_interval
         self.bests = None
+        self.splits = None
+        self.origin = None
+        self.track = track
+        self.publisher = RESTPublisher() if publisher is None else publisher
+        self.beacons = beacons
+        self.journal = journal
+        self.race = None
+        # Wall-clock time at which the race started, to be able to
+        # resume it after a restart of the application
+        self._started = None
+        self._replaying = False
+        # Events are recorded in the order they are applied
+        self._lock = RLock()
+        # Readers get the last published version without locking
+        self.snapshot = Snapshot(0, False, ())
+        self._changed = {}
+        # Latest status of drones changed since the last batch was sent
+        self._outgoing = {}
+        self._flush_timer = None
+
+    def elapsed(self):
+        """Return the amount of seconds elapsed since the start of the
+        current race, at the resolution of the clock.
+        """
+        return self.clock.seconds(self.clock.now() - self.origin)
+
+    def _drones(self):
+        """Iterate over the drones attending the current race."""
+        return (drone for drone in self.scores if drone is not None)
+
+    def _publish(self, drone):
+        """Mark the status of a drone as changed so that it is part of the
+        next version of the leader-board.
+        """
+        self._changed[drone['id'] - 1] = drone
+
+    def subscribe(self, callback):
+        """Register a function to call with each batch of statuses of
+        drones that changed.
+
+        Parameter:
+          - callback: function accepting a tuple of FrozenRow
+        """
+        self.subscribers.append(callback)
+
+    def _commit(self, publish=True):
+        """Publish a new version of the leader-board that shares the rows
+        of unchanged drones with the previous one. Queue the new status of
+        changed drones for the next batch sent to the subscribers.
+
+        Parameter:
+          - publish: whether or not changed drones should be sent
+        """
+        rows = list(self.snapshot.drones)
+        rows.extend(None for _ in range(len(self.scores) - len(rows)))
+        del rows[len(self.scores):]
+        changed = [
+                (index, FrozenRow(drone))
+                for index, drone in self._changed.items()]
+        self._changed = {}
+        for index, row in changed:
+            rows[index] = row
+        self.snapshot = Snapshot(
+                self.snapshot.version + 1,
+                self.extra_data is not None,
+                tuple(rows))
+        if publish:
+            self._outgoing.update(changed)
+            if not self.flush_interval:
+                self._flush()
+            elif self._flush_timer is None and self._outgoing:
+                self._flush_timer = self.clock.call_later(
+                        self.flush_interval, self._flush)
+
+    def _flush(self):
+        """Send the statuses gathered since the last batch to the publisher
+        and to the subscribers. Each drone appears at most once.
+        """
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            batch = tuple(self._outgoing.values())
+            self._outgoing = {}
+            # Deliver while locked so that batches can not overtake each
+            # other nor the end of the race
+            if batch:
+                self.publisher.updates(batch, self.track)
+                for callback in self.subscribers:
+                    callback(batch)
+
+    def _record(self, *event):
+        """Append an event that has just been applied to the journal.
+        Store a snapshot of the race instead when enough events have
+        been recorded since the last one.
+        """
+        if self.journal is None or self._replaying:
+            return
+        if self.journal.since_snapshot >= self.journal.snapshot_every:
+            self.journal.snapshot(self._state())
+        else:
+            self.journal.write(*event)
+
+    def _state(self):
+        """Return the state of the race in a picklable representation."""
+        return {
+            'race': self.race,
+            'scores': self.scores,
+            'bests': self.bests,
+            'splits': self.splits,
+            'rules': self.rules,
+            'judged': self._rules,
+            'started': self._started,
+            'extra_data': None if self.extra_data is None else [
+                None if data is None else dict(data, timer=None)
+                for data in self.extra_data],
+        }
+
+    def accepts(self, gate, drone):
+        """Return whether or not an event from the reader is meant for
+        the race started on this console.
 
-    def setup_race(self, drones, rules):
+        Parameters:
+          - gate: identification letter(s) of the gate that was reached
+          - drone: the 0-based identification number of the drone
+        """
+        if self.extra_data is None or gate not in self.gates:
+            return False
+        return 0 <= drone < len(self.scores) and self.scores[drone] is not None
+
+    def setup_race(self, drones, rules, race=None):
         """Initialize a new race.
 
         Parameters:
-          - nb_drones: the amount of drones attending the race
+          - drones: the beacons of the drones attending the race
           - rules: the Rules object owning the rules of this race
+          - race: identification number of the race in the database
         """
-        # Check that no other race is currently started
-        if self.extra_data is not None:
-            raise ConsoleError(_('Race ongoing. Stop it or wait for its end'))
-        self.scores = [{
-            'id': id,
-            'position': len(drones),
-            'points': 0,
-            'temps': 0.0,
-            'retard': 0.0,
-            'tour': None,
-            'finish': None,
-            'porte': None,
-            'tours': 0,
-        } if id in drones else None for id in range(1, max(drones)+1)]
-        self.bests = [[] for _ in range(max(drones))]
-        # Faster lookup to decide whether or not to compute
-        # the signal from a given gate
-        self.gates = rules.gates.keys()
-        self.rules = rules
+        with self._lock:
+            # Check that no other race is currently started
+            if self.extra_data is not None:
+                raise ConsoleError(_(
+                        'Race ongoing. Stop it or wait for its end'))
+            # Check that the drones are allowed on this track
+            forbidden = set(drones) - set(self.beacons or drones)
+            if forbidden:
+                raise ConsoleError(_(
+                        'Beacons {} are not allowed on this track').format(
+                        ', '.join(map(str, sorted(forbidden)))))
+            self.scores = [{
+                'id': id,
+                'position': len(drones),
+                'points': 0,
+                'temps': 0.0,
+                'retard': 0.0,
+                'tour': None,
+                'finish': None,
+                'porte': None,
+                'tours': 0,
+            } if id in drones else None for id in range(1, max(drones)+1)]
+            self.bests = [array('d') for _ in range(max(drones))]
+            self.splits = Splits(max(drones), [
+                    gate for gate, setup in rules.gates.items()
+                    if Gates(setup['type']).is_time],
+                    self.clock.resolution)
+            # Faster lookup to decide whether or not to compute
+            # the signal from a given gate
+            self.gates = rules.gates.keys()
+            self.rules = rules
+            self._rules = rules
+            self.race = race
+            self._started = None
+            # Events of a previous race are not needed anymore
+            if self.journal is not None:
+                self.journal.snapshot(self._state())
+            for drone in self._drones():
+                self._publish(drone)
+            self._commit(publish=False)
 
     def cancel_race(self):
         """Cancel the last race configured. Does not matter if it was
         started or not.
         """
-        # Check that a race has already been configured
-        if self.rules is None:
-            raise ConsoleError(_('Cancelation failed: no race setup'))
+        with self._lock:
+            # Check that a race has already been configured
+            if self.rules is None:
+                raise ConsoleError(_('Cancelation failed: no race setup'))
+            self._cancel()
+            self._record('cancel')
+            self._commit(publish=False)
+
+    def _cancel(self):
+        """Apply the cancelation of the race."""
+        if not self._replaying:
+            self._flush()
         # Every drone get the same meaningless informations
-        for drone in self.scores:
-            if drone is not None:
-                drone['position'] = None
-                drone['points'] = None
-                drone['temps'] = None
-                drone['tours'] = None
-                drone['tour'] = None
-                drone['finish'] = False
-                drone['retard'] = None
+        for drone in self._drones():
+            drone['position'] = None
+            drone['points'] = None
+            drone['temps'] = None
+            drone['tours'] = None
+            drone['tour'] = None
+            drone['finish'] = False
+            drone['retard'] = None
+            self._publish(drone)
         # Cancel each drone's timer if there was a time limit
-        if self.extra_data and self.rules.timeout:
-            for data in self.extra_data:
-                if data is not None:
-                    data['timer'].cancel()
+        for data in self.extra_data or ():
+            if data is not None and data['timer']:
+                data['timer'].cancel()
         self.rules = None
+        self._rules = None
         self.extra_data = None
-        rest.cancel()
+        if not self._replaying:
+            self.publisher.cancel(self.track)
 
     def start_race(self):
         """Start monitoring events for the last configured race."""
-        # Check that there is not a race already started
-        if self.extra_data is not None:
-            raise ConsoleError(_('Race ongoing. Stop it or wait for its end'))
-        # Check that a race has already been configured
-        if self.rules is None:
-            raise ConsoleError(_('Can not start race: no race setup'))
+        with self._lock:
+            # Check that there is not a race already started
+            if self.extra_data is not None:
+                raise ConsoleError(_(
+                        'Race ongoing. Stop it or wait for its end'))
+            # Check that a race has already been configured
+            if self.rules is None:
+                raise ConsoleError(_('Can not start race: no race setup'))
+            self.origin = self.clock.now()
+            started = self.clock.wall()
+            self._start(started)
+            self._record('start', started)
+            # Start every drone's timer right now if there
+            # is no starting mark
+            if self.rules.common_start:
+                for index, data in enumerate(self.extra_data):
+                    if data is not None:
+                        self._arm_timer(index, self.rules.timeout)
+            self._commit()
+
+    def _start(self, started):
+        """Apply the start of the race at the given wall-clock time."""
+        self._started = started
         start = self.rules.common_start
-        t_out = self.rules.timeout / 10 if self.rules.timeout else None
         self.extra_data = [{
             'offset': 0 if start else None,
             'time_laps': 0,
-            'timer': Timer(t_out, self._check_laps,
-                (drone['id'],)) if t_out else None,
+            'timer': None,
         } if drone is not None else None for drone in self.scores]
-        # Start every drone's timer right now if there is no starting mark
-        if t_out and start:
-            for data in self.extra_data:
-                if data is not None:
-                    data['timer'].start()
+
+    def _arm_timer(self, index, delay):
+        """Schedule the end of the allotted time for a drone.
+
+        Parameters:
+          - index: the 0-based identification number of the drone
+          - delay: time remaining to the drone to clear the race
+        """
+        if self._replaying or not self.rules.timeout:
+            return
+        self.extra_data[index]['timer'] = self.clock.call_later(
+                delay, self._check_laps, index + 1)
 
     def stop_race(self):
         """Halt the current race and stop monitoring for events."""
-        # Check that there is a race already started
-        if self.extra_data is None:
-            raise ConsoleError(_('No race to stop'))
-        rest.finish()
+        with self._lock:
+            # Check that there is a race already started
+            if self.extra_data is None:
+                raise ConsoleError(_('No race to stop'))
+            time = self.elapsed()
+            self._stop(time)
+            self._record('stop', time)
+
+    def _stop(self, time):
+        """Apply the end of the race at the given time."""
         # Update status for drones that don't already cleared the race
-        time = self.timer()
         for drone, extra in zip(self.scores, self.extra_data):
             if drone is None:
                 continue
-            if self.rules.timeout:
+            if extra['timer']:
                 extra['timer'].cancel()
             if drone['finish'] is None:
                 offset = extra['offset'] or 0
                 drone['finish'] = not self.rules.timed_out(time - offset)
-            rest.update(drone)
-            self.update(drone)
+            self._publish(drone)
         self.rules = None
         self.extra_data = None
+        if not self._replaying:
+            # Final statuses are sent before the end of the race
+            self._commit()
+            self._flush()
+            self.publisher.finish(self.track)
+
+    def close_race(self):
+        """Forget the last race once its results are stored. It does not
+        accept judge edits anymore and is not recovered after a restart.
+        """
+        with self._lock:
+            # Check that the race is over
+            if self.extra_data is not None:
+                raise ConsoleError(_(
+                        'Race ongoing. Stop it or wait for its end'))
+            self._close()
+            self._record('close')
+
+    def _close(self):
+        """Apply the closing of the race."""
+        self._rules = None
+
+    def recover(self):
+        """Rebuild the state of the last race from the journal and resume
+        it if it was not over. A race that is over but whose results were
+        not closed yet is recovered too, so that they are not lost.
+
+        Return whether or not a race has been resumed.
+        """
+        if self.journal is None:
+            return False
+        state, events = self.journal.read()
+        if state is None:
+            return False
+        appliers = {
+            'passage': self._process,
+            'timeout': self._timeout,
+            'start': self._start,
+            'stop': self._stop,
+            'cancel': self._cancel,
+            'score': self._edit_score,
+            'amend': self._amend_time,
+            'kill': self._kill_drone,
+            'close': self._close,
+        }
+        with self._lock:
+            self._replaying = True
+            try:
+                self.race = state['race']
+                self.scores = state['scores']
+                self.bests = state['bests']
+                self.splits = state.get('splits')
+                self.rules = state['rules']
+                self._rules = state.get('judged', self.rules)
+                self.extra_data = state['extra_data']
+                self._started = state['started']
+                self.gates = self.rules and self.rules.gates.keys()
+                for event, *args in events:
+                    appliers[event](*args)
+            finally:
+                self._replaying = False
+            # Compact the journal so that the next recovery is immediate
+            self.journal.snapshot(self._state())
+            if self._rules is None:
+                self._changed = {}
+                return False
+            if self.extra_data is not None:
+                elapsed = self.clock.wall() - self._started
+                self.origin = self.clock.now() - self.clock.ticks(elapsed)
+                for index, data in enumerate(self.extra_data):
+                    if data is None or data['offset'] is None:
+                        continue
+                    # Races without a time limit have no timer to arm
+                    if (self.rules.timeout and
+                            self.scores[index]['finish'] is None):
+                        self._arm_timer(index, self.rules.timeout -
+                                (elapsed - data['offset']))
+            for drone in self._drones():
+                self._publish(drone)
+            # Spectators already know about the end of the race
+            self._commit(publish=self.rules is not None)
+        return True
+
+    def best_sectors(self, drone):
+        """Return the best times of a drone on each sector of the route,
+        as measured by the timing gates, indexed by the gate ending the
+        sector.
+
+        Parameter:
+          - drone: identification number of the beacon attached to the drone
+        """
+        with self._lock:
+            if self.splits is None:
+                return {}
+            return self.splits.best_sectors(drone - 1)
 
     def compute_leaderboard(self):
         """Compute best lap for each drone and filter out dead ones."""
-        for drone, best in zip(self.scores, self.bests):
-            if drone is not None:
-                b = min(best or (-1,))
-                drone['tour'] = None if b == -1 else b
-        return [drone for drone in self.scores if drone is not None]
+        with self._lock:
+            for index, (drone, best) in enumerate(zip(self.scores, self.bests)):
+                if drone is None:
+                    continue
+                if self._rules is not None:
+                    drone['tour'] = self._rules.best_time(index, best)
+                else:
+                    b = min(best or (-1,))
+                    drone['tour'] = None if b == -1 else b
+                self._publish(drone)
+            self._commit(publish=False)
+            return self.snapshot.leaderboard
 
     def _check_laps(self, drone):
         """Monitoring function that gets called for each drone at the end
         of its timer.
+        """
+        with self._lock:
+            if self.extra_data is None:
+                return
+            time = self.elapsed()
+            self._timeout(drone, time)
+            self._record('timeout', drone, time)
+            self._commit()
 
-        Check if a drone has a remaining lap to clear and update its status
-        accordingly.
+    def _timeout(self, drone, time):
+        """Check if a drone has a remaining lap to clear and update its
+        status accordingly.
         """
         data = self.extra_data[drone-1]
         drone = self.scores[drone-1]
         # Nothing to do if the drone already cleared the race
         if drone is None or drone['finish'] is not None:
             return
-        time = self.timer()
-        time -= data['offset'] or 0
-        drone['temps'] = time / 10
+        race_time = time
+        time = self.clock.round(time - (data['offset'] or 0))
+        drone['temps'] = self.clock.round(
+                time + self.rules.penalty(drone['id']-1))
         # Enforce a status if strict timming
         if self.rules.strict:
             drone['finish'] = self.rules.nb_laps is None
-            # Check if all drones cleared the race
-            if not [True for d in self.scores if d['finish'] is None]:
-                self.stop_race()
         else:
             drone_lap = drone['tours']
-            min_lap = min(d['tours'] for d in self.scores)
+            min_lap = min(d['tours'] for d in self._drones())
             if drone_lap != min_lap:
                 drone['finish'] = True
-        rest.update(drone)
-        self.update(drone)
+        self._publish(drone)
+        # Check if all drones cleared the race
+        if self.rules.strict and not [
+                True for d in self._drones() if d['finish'] is None]:
+            self._stop(race_time)
 
     def compute_data(self, gate, drone):
         """React to events on the race as sent by the reader thread and
         update drone statuses accordingly.
         """
-        # Do not process anything when no race is started
-        if self.extra_data is None:
-            return
-        # Do not process data for a gate that is not activated for this race
-        if not (gate in self.gates and 0 <= drone < len(self.scores)):
-            return
-        time = self.timer()
-        data = self.extra_data[drone]
-        best = self.bests[drone]
-        drone = self.scores[drone]
-        # Drones are not allowed to continue when they finished a race
-        if drone is None or drone['finish'] is not None:
-            return
-        time -= data['offset'] or 0
+        with self._lock:
+            # Do not process anything when no race is started
+            if self.extra_data is None:
+                return
+            # Do not process data for a gate that is not activated
+            # for this race
+            if not (gate in self.gates and 0 <= drone < len(self.scores)):
+                return
+            # Drones are not allowed to continue when they finished a race
+            status = self.scores[drone]
+            if status is None or status['finish'] is not None:
+                return
+            time = self.elapsed()
+            self._process(gate, drone, time)
+            self._record('passage', gate, drone, time)
+            self._commit()
+
+    def _process(self, gate, index, time):
+        """Update the status of a drone going through a gate.
+
+        Parameters:
+          - gate: identification letter(s) of the gate the drone just reached
+          - index: the 0-based identification number of the drone
+          - time: time elapsed since the beginning of the race
+        """
+        race_time = time
+        data = self.extra_data[index]
+        best = self.bests[index]
+        drone = self.scores[index]
+        time = self.clock.round(time - (data['offset'] or 0))
         # Compute state of the drone
         score, pos, delay, turn, on_going, start = self.rules.compute_score(
                 gate, drone['porte'], drone['id']-1, time)
+        delay = self.clock.round(delay)
         # Drones *must* go through the starting mark so they can claim points
         if drone['porte'] is None and not start and not self.rules.common_start:
             return
@@ -198,17 +569,16 @@ class Console:
             data['offset'] = time
             time = 0
             drone['tours'] -= int(turn)
-            timer = data['timer']
-            if timer:
-                timer.start()
+            self._arm_timer(index, self.rules.timeout)
+        self.splits.record(index, gate, time)
         # Store general informations
-        drone['temps'] = time / 10
+        drone['temps'] = self.clock.round(time + self.rules.penalty(index))
         drone['points'] += score
         drone['porte'] = gate
         # Compute lap time when the drone goes through the finish line
         if turn:
             drone['tours'] += 1
-            drone['tour'] = (time - data['time_laps']) / 10
+            drone['tour'] = self.clock.round(time - data['time_laps'])
             best.append(drone['tour'])
             data['time_laps'] = time
             # If the race timed out or the drone performed enough laps
@@ -217,36 +587,68 @@ class Console:
                     self.rules.race_done(drone['tours'])) else None
         # Account for position change if the gate was able to compute one
         if pos > 0:
-            current_position = drone['position']
-            # The drone climbed the leader-board
-            if pos < current_position:
-                drone['position'] = pos
-                drone['retard'] = delay if pos > 1 else 0.0
-                delay = 0.0 if pos > 1 else delay
-                nb_drones = len(self.scores)
-                for d in self.scores:
-                    if d['position'] >= pos and d is not drone:
-                        d['position'] = min(nb_drones, d['position'] + 1)
-                        d['retard'] += delay
-                        rest.update(d)
-                        self.update(d)
-            # The drone dropped down the leader-board
-            elif pos > current_position:
-                for d in self.scores:
-                    if current_position > d['position'] >= pos:
-                        d['position'] -= 1
-                        rest.update(d)
-                        self.update(d)
-                drone['position'] = pos
-                drone['retard'] = delay
-            # The drone kept its position
-            else:
-                drone['retard'] = delay
-        rest.update(drone)
-        self.update(drone)
+            self._move(drone, pos, delay)
+        self._publish(drone)
         # Check if all drones cleared the race
-        if not [True for d in self.scores if d['finish'] is None]:
-            self.stop_race()
+        if not [True for d in self._drones() if d['finish'] is None]:
+            self._stop(race_time)
+
+    def _move(self, drone, pos, delay):
+        """Update the position of a drone on the leader-board and the
+        positions of the drones it overtook or that overtook it.
+
+        Parameters:
+          - drone: the status of the drone
+          - pos: the new ranking of the drone
+          - delay: delay of the drone on the leading one (or advance on the
+            second one if the drone leads)
+        """
+        current_position = drone['position']
+        # The drone climbed the leader-board
+        if pos < current_position:
+            drone['position'] = pos
+            drone['retard'] = delay if pos > 1 else 0.0
+            delay = 0.0 if pos > 1 else delay
+            for d in self._drones():
+                if d['position'] >= pos and d is not drone:
+                    # Only drones that were overtaken lose a rank
+                    if d['position'] < current_position:
+                        d['position'] += 1
+                    d['retard'] = self.clock.round(d['retard'] + delay)
+                    self._publish(d)
+        # The drone dropped down the leader-board
+        elif pos > current_position:
+            for d in self._drones():
+                if current_position < d['position'] <= pos:
+                    d['position'] -= 1
+                    self._publish(d)
+            # Delays are now counted from the drone that took the lead
+            if current_position == 1:
+                leaders = [
+                        d['retard'] for d in self._drones()
+                        if d['position'] == 1 and d is not drone]
+                advance = min(leaders, default=0.0)
+                for d in self._drones():
+                    if d is not drone and advance:
+                        d['retard'] = self.clock.round(d['retard'] - advance)
+                        self._publish(d)
+            drone['position'] = pos
+            drone['retard'] = delay
+        # The drone kept its position
+        elif pos > 1:
+            drone['retard'] = delay
+        # The leader kept its lead: its advance on the second drone tells
+        # how much the delays of the others changed
+        else:
+            drone['retard'] = 0.0
+            seconds = [
+                    d['retard'] for d in self._drones()
+                    if d['position'] == 2]
+            shift = delay - min(seconds) if seconds and delay else 0.0
+            for d in self._drones():
+                if d is not drone and shift:
+                    d['retard'] = self.clock.round(d['retard'] + shift)
+                    self._publish(d)
 
     def edit_score(self, drone, amount):
         """Manually modify the score associated to a drone.
@@ -256,12 +658,24 @@ class Console:
             the drone to modify
           - amount: the quantity of points to add to this drone
         """
+        with self._lock:
+            self._edit_score(drone, amount)
+            self._record('score', drone, amount)
+            self._commit()
+
+    def _edit_score(self, drone, amount):
+        """Apply a modification of the score of a drone."""
         # Account for line 47
-        drone = self.scores[drone-1]
+        index = drone - 1
+        drone = self.scores[index]
         if drone is not None:
             drone['points'] += amount
-            rest.update(drone)
-            self.update(drone)
+            # Rankings based on points must account for the edit
+            if self._rules is not None:
+                pos = self._rules.add_points(index, amount)
+                if pos > 0:
+                    self._move(drone, pos, 0.0)
+            self._publish(drone)
 
     def amend_time(self, drone, amount, lap):
         """Manually modify the time of a lap for a specific drone.
@@ -272,8 +686,21 @@ class Console:
           - amount: the quantity of seconds to add to this drone
           - lap: the lap to add seconds to
         """
+        with self._lock:
+            self._amend_time(drone, amount, lap)
+            self._record('amend', drone, amount, lap)
+            self._commit()
+
+    def _amend_time(self, drone, amount, lap):
+        """Apply a modification of the time of a lap of a drone.
+
+        The amount is added to the time of every passage of the drone since
+        the end of the lap, so that only the rankings of these passages and
+        the positions depending on them are computed again.
+        """
         # Account for line 47
-        best = self.bests[drone-1]
+        index = drone - 1
+        best = self.bests[index]
         try:
             best[lap-1] += amount
         except IndexError:
@@ -282,12 +709,15 @@ class Console:
                 'Can not modify the first one.',
                 'This drone flew for only {} rounds. '
                 'Can not modify the {}th one.', lap).format(len(best), lap))
-        else:
-            if lap == len(best):
-                drone = self.scores[drone-1]
-                drone['tour'] = best[-1]
-                self.update(drone)
-                rest.update(drone)
+        drone = self.scores[index]
+        drone['temps'] = self.clock.round(drone['temps'] + amount)
+        if lap == len(best):
+            drone['tour'] = best[-1]
+        if self._rules is not None:
+            pos, delay = self._rules.amend(index, lap, amount)
+            if pos > 0:
+                self._move(drone, pos, self.clock.round(delay))
+        self._publish(drone)
 
     def kill_drone(self, drone):
         """Declare that a drone is no good anymore and won't be able to
@@ -296,12 +726,137 @@ class Console:
         Parameter:
           - drone: identification number of the beacon attached to the drone
         """
+        with self._lock:
+            self._kill_drone(drone)
+            self._record('kill', drone)
+            self._commit()
+
+    def _kill_drone(self, drone):
+        """Apply the death of a drone."""
         # Account for line 47
         drone = self.scores[drone-1]
         if drone is not None:
             drone['finish'] = False
-            rest.update(drone)
-            self.update(drone)
+            self._publish(drone)
+
+
+class RaceRegistry:
+    """Collection of consoles managing races that run in parallel on
+    separate tracks while sharing the same reader.
+    """
+
+    def __init__(self):
+        """Create an empty registry. Tracks must be added before any event
+        can be routed to them.
+        """
+        self.consoles = {}
+
+    def __getitem__(self, track):
+        """Return the console managing the races of the given track."""
+        return self.consoles[track]
+
+    def __iter__(self):
+        """Iterate over the consoles of every registered track."""
+        return iter(self.consoles.values())
+
+    def add_track(self, console):
+        """Register a console so that it receives the events meant for
+        its track.
+
+        Parameter:
+          - console: the Console object managing races on the track
+        """
+        if console.track in self.consoles:
+            raise ConsoleError(_('Track {} is already registered').format(
+                    console.track))
+        self.consoles[console.track] = console
+
+    def remove_track(self, track):
+        """Stop routing events to the given track.
+
+        Parameter:
+          - track: the name of the track to remove
+        """
+        console = self.consoles.pop(track)
+        if console.extra_data is not None:
+            console.stop_race()
+
+    def setup_race(self, track, drones, rules, race=None):
+        """Initialize a new race on the given track after checking that
+        it does not collide with the races configured on other tracks.
+
+        Parameters:
+          - track: the name of the track to setup the race on
+          - drones: the beacons of the drones attending the race
+          - rules: the Rules object owning the rules of this race
+          - race: identification number of the race in the database
+        """
+        for console in self.consoles.values():
+            if console.track == track or console.rules is None:
+                continue
+            shared_gates = set(console.gates) & set(rules.gates)
+            shared_drones = set(drones) & {
+                    drone['id'] for drone in console.scores
+                    if drone is not None}
+            if shared_gates and shared_drones:
+                raise ConsoleError(_(
+                        'Gates {} and beacons {} are already used on '
+                        'track {}').format(
+                        ', '.join(sorted(shared_gates)),
+                        ', '.join(map(str, sorted(shared_drones))),
+                        console.track))
+        self.consoles[track].setup_race(drones, rules, race)
+
+    def compute_data(self, gate, drone):
+        """Route an event sent by the reader thread to the race it
+        belongs to.
+
+        Parameters:
+          - gate: identification letter(s) of the gate that was reached
+          - drone: the 0-based identification number of the drone
+        """
+        for console in self.consoles.values():
+            if console.accepts(gate, drone):
+                console.compute_data(gate, drone)
+                return
+
+
+class RulesCache:
+    """Least recently used routes, compiled into Rules objects, so that
+    back-to-back races on the same route do not validate it again.
+    """
+
+    def __init__(self, size=16):
+        """Create an empty cache.
+
+        Parameter:
+          - size: maximum amount of compiled routes to keep
+        """
+        self.size = size
+        self._rules = OrderedDict()
+
+    def get(self, key, compile):
+        """Return a Rules object ready to be used for a new race.
+
+        Parameters:
+          - key: identification of the route and its revision, as returned
+            by `Database.get_game_revision`
+          - compile: function building the Rules object when the route is
+            not in the cache
+        """
+        try:
+            rules = self._rules[key]
+        except KeyError:
+            rules = self._rules[key] = compile()
+            if len(self._rules) > self.size:
+                self._rules.popitem(last=False)
+        else:
+            self._rules.move_to_end(key)
+        return rules.copy()
+
+    def clear(self):
+        """Forget every compiled route."""
+        self._rules.clear()
 
 
 class Gates(Enum):
@@ -342,7 +897,7 @@ class Rules:
         """Create a route and check its validity.
 
         Parameters:
-          - timeout: allotted time to clear the race
+          - timeout: allotted time, in seconds, to clear the race
           - strict: whether the race should stop immediately after the timeout
             or if late drones have a chance of finishing their lap
           - nb_laps: number of laps required to clear the race
@@ -357,11 +912,11 @@ class Rules:
             raise ConsoleError(_(
                     'Strict mode was specified: '
                     'time for the race is missing.'))
-        # Account for the fact that the timer counts in tenths of seconds
-        # and the timeout value is given in seconds
-        self.timeout = timeout * 10 or None
+        self.timeout = timeout or None
         self.strict = strict
         self.nb_laps = nb_laps or None
+        # Time added by the judges to the passages of each drone
+        self.penalties = {}
         # Check the route validity
         gates_type = [v[1] for v in gates]
         # Check that there is at most one starting mark
@@ -380,6 +935,8 @@ class Rules:
                 'next': v[3],
                 'times': {} if (Gates(v[1]).is_end or
                     self.common_start) else None,
+                # Sorted times of every drone for each passage number
+                'ranks': {},
             } for v in gates}
         try:
             for b,v in self.gates.items():
@@ -389,12 +946,30 @@ class Rules:
                     'The gate following gate "{0}" is set to "{1}" but '
                     'gate "{1}" does not exist').format(b, v['next']))
 
+    def copy(self):
+        """Return a Rules object sharing the validated route of this one but
+        without any information about the progress of a race.
+        """
+        rules = object.__new__(type(self))
+        rules.__dict__.update(self.__dict__)
+        rules._reset()
+        return rules
+
+    def _reset(self):
+        """Forget everything recorded about the progress of a race."""
+        self.penalties = {}
+        self.gates = {
+            name: dict(gate, ranks={},
+                times=None if gate['times'] is None else {})
+            for name, gate in self.gates.items()}
+
     def get_setup(self):
         """Return this route and rules definition in a JSON-ready
         representation.
         """
         return {
-            'temps': self.timeout,
+            # Available time is sent in tenths of seconds
+            'temps': self.timeout and self.timeout * 10,
             'tours': self.nb_laps,
             'portes': sorted(self.gates.keys()),
         }
@@ -425,30 +1000,117 @@ class Rules:
         start = previous is None and Gates(type).is_start
         # Check if the drone cleared a lap
         end = Gates(type).is_end
-        # Compute points
+        # Compute points, time gates grant them per tenth of second remaining
         remaining = self.timeout - time if self.timeout is not None else 0
         running = remaining >= 0
         if (previous is None or previous in gate['previous']) and running:
-            pts = pts if Gates(type).is_points else remaining*pts
+            pts = pts if Gates(type).is_points else int(remaining*10)*pts
         else:
             pts = 0
-        pos, delay = -1, 0
+        pos, delay = 0, 0
         # Compute position if gate is able to
         if times is not None:
+            time += self.penalty(drone)
             drone_times = times.setdefault(drone, [])
             drone_times.append(time)
-            laps = len(drone_times) - 1
-            everyones_time = sorted(
-                    [t[laps] for t in times.values() if len(t) > laps])
-            pos = everyones_time.index(time)
-            # if pos is 0 the drone is the fastest for this gate so its delay
-            # should be 0, but we compute the delay of the second drone to be
-            # able to update everyone-else's delay
-            if pos:
-                delay = everyones_time[pos] - everyones_time[0]
-            elif len(everyones_time) > 1:
-                delay = everyones_time[1] - everyones_time[0]
-        return pts, pos+1, delay/10, end, running, start
+            everyones_time = gate['ranks'].setdefault(len(drone_times) - 1, [])
+            insort(everyones_time, time)
+            pos, delay = self._rank(everyones_time, time)
+        return pts, pos, delay, end, running, start
+
+    @staticmethod
+    def _rank(everyones_time, time):
+        """Return the ranking of a drone for a passage through a gate and
+        its delay on the leading drone (or advance on the second).
+
+        Parameters:
+          - everyones_time: sorted times of the drones for this passage
+          - time: time of the drone for this passage
+        """
+        pos = bisect_left(everyones_time, time)
+        # if pos is 0 the drone is the fastest for this gate so its delay
+        # should be 0, but we compute the delay of the second drone to be
+        # able to update everyone-else's delay
+        if pos:
+            delay = everyones_time[pos] - everyones_time[0]
+        elif len(everyones_time) > 1:
+            delay = everyones_time[1] - everyones_time[0]
+        else:
+            delay = 0
+        return pos+1, delay
+
+    def penalty(self, drone):
+        """Return the amount of seconds added by the judges to the time of
+        a drone.
+
+        Parameter:
+          - drone: the ordering index of the drone
+        """
+        return self.penalties.get(drone, 0)
+
+    def amend(self, drone, lap, amount):
+        """Add time to the passages of a drone that happened since the end
+        of a lap and update the rankings of these passages.
+
+        Parameters:
+          - drone: the ordering index of the drone
+          - lap: the lap whose time is modified, as numbered by the console
+          - amount: the quantity of seconds to add to these passages
+
+        Return the ranking of the drone for its last amended passage and its
+        delay on the leading drone (or advance on the second), or (-1, 0)
+        if none of its passages were ranked.
+        """
+        self.penalties[drone] = self.penalty(drone) + amount
+        # Each passage through the finish line accounts for a lap
+        finish, = (g for g in self.gates.values() if Gates(g['type']).is_end)
+        laps = finish['times'].get(drone, ())
+        if not 0 < lap <= len(laps):
+            return -1, 0
+        since = laps[lap-1]
+        latest, pos, delay = None, -1, 0
+        for gate in self.gates.values():
+            drone_times = (gate['times'] or {}).get(drone)
+            if not drone_times:
+                continue
+            if gate is finish:
+                first = lap - 1
+            else:
+                first = bisect_left(drone_times, since)
+            for passage in range(first, len(drone_times)):
+                time = drone_times[passage]
+                everyones_time = gate['ranks'][passage]
+                del everyones_time[bisect_left(everyones_time, time)]
+                drone_times[passage] = time = time + amount
+                insort(everyones_time, time)
+            if first < len(drone_times) and (
+                    latest is None or drone_times[-1] > latest):
+                latest = drone_times[-1]
+                pos, delay = self._rank(
+                        gate['ranks'][len(drone_times) - 1], latest)
+        return pos, delay
+
+    def add_points(self, drone, amount):
+        """Account for points given by the judges to a drone.
+
+        Parameters:
+          - drone: the ordering index of the drone
+          - amount: the quantity of points added
+
+        Return the new ranking of the drone, or -1 if rankings do not
+        depend on points.
+        """
+        return -1
+
+    def best_time(self, drone, laps):
+        """Return the time shown on the final leader-board for a drone,
+        or None if it did not clear any lap.
+
+        Parameters:
+          - drone: the ordering index of the drone
+          - laps: the times of the laps cleared by the drone
+        """
+        return min(laps) if laps else None
 
     def timed_out(self, time):
         """Return whether or not the race has stopped at a given moment
@@ -469,6 +1131,167 @@ class Rules:
         return self.nb_laps is not None and lap >= self.nb_laps
 
 
+class Qualifying(Rules):
+    """Custom set of rules ranking drones on the best time they achieved
+    over a given amount of consecutive laps.
+
+    Routes stored in the database do not select these rules: they are
+    meant to be built by callers of the console directly.
+    """
+
+    # Lap times are summed as integers to avoid accumulating rounding
+    # errors in the sliding windows
+    NANOSECONDS = 10**9
+
+    def __init__(self, timeout, strict, nb_laps, gates, consecutive=3):
+        """Create a route and check its validity.
+
+        Parameters:
+          - timeout: allotted time, in seconds, to clear the race
+          - strict: whether the race should stop immediately after the timeout
+            or if late drones have a chance of finishing their lap
+          - nb_laps: number of laps required to clear the race
+          - gates: list of 4-items-sequences defining the active gates for
+            the race:
+              - identification letter(s) for the gate
+              - kind of gate as defined by the Gates enum
+              - number of points associated to this gate
+              - identification letter(s) for the next gate after this one
+          - consecutive: amount of consecutive laps whose times are summed
+            to rank the drones
+        """
+        super().__init__(timeout, strict, nb_laps, gates)
+        if consecutive < 1:
+            raise ConsoleError(_(
+                    'At least one lap must be accounted for in qualifiers'))
+        self.consecutive = consecutive
+        self._clear_windows()
+
+    def _reset(self):
+        """Forget everything recorded about the progress of a race."""
+        super()._reset()
+        self._clear_windows()
+
+    def _clear_windows(self):
+        """Forget the laps recorded for every drone."""
+        # Time at which each drone started its current lap
+        self.lap_starts = {}
+        # Laps counted by the console before the first one timed here,
+        # when the starting mark is also the finish line
+        self.skipped = {}
+        # Times of the laps of each drone and sum of the last ones
+        self.laps = {}
+        self.sums = {}
+        # Best sum of each drone and sorted bests of everyone
+        self.best_windows = {}
+        self.ranking = []
+
+    def compute_score(self, gate, previous, drone, time):
+        """Compute the amount of points given to a drone when it goes
+        through a gate.
+
+        Parameters:
+          - gate: identification letter(s) of the gate the drone just reached
+          - previous: identification letter(s) of the previous gate reached
+            by the drone
+          - drone: the ordering index of the drone
+          - time: time since the beginning of the race at which the drone
+            reached the gate
+
+        Return a 6-items-sequence:
+          - amount of points awarded for reaching this gate
+          - ranking of the drone on its best consecutive laps if they just
+            improved, 0 otherwise
+          - delay of these laps on the leading drone (or advance on the
+            second)
+          - whether or not a lap has been cleared
+          - whether or not the drone has reached its timeout
+          - whether or not the drone reached the starting mark for the first time
+        """
+        pts, _, _, end, running, start = super().compute_score(
+                gate, previous, drone, time)
+        if start:
+            # Following times are relative to the starting mark
+            self.lap_starts[drone] = 0
+            self.skipped[drone] = int(end)
+            return pts, 0, 0, end, running, start
+        if not end:
+            return pts, 0, 0, end, running, start
+        time = round(time * self.NANOSECONDS)
+        lap = time - self.lap_starts.get(drone, 0)
+        self.lap_starts[drone] = time
+        # Slide the window over the last laps
+        laps = self.laps.setdefault(drone, [])
+        laps.append(lap)
+        total = self.sums.get(drone, 0) + lap
+        if len(laps) > self.consecutive:
+            total -= laps[-self.consecutive-1]
+        self.sums[drone] = total
+        best = self.best_windows.get(drone)
+        if len(laps) < self.consecutive or (
+                best is not None and best <= total):
+            return pts, 0, 0, end, running, start
+        pos, delay = self._improve(drone, total)
+        return pts, pos, delay, end, running, start
+
+    def _improve(self, drone, total):
+        """Store the best time of a drone over consecutive laps and rank it.
+
+        Return the ranking of the drone and its delay, in seconds, on the
+        leading drone (or advance on the second).
+        """
+        best = self.best_windows.get(drone)
+        if best is not None:
+            del self.ranking[bisect_left(self.ranking, best)]
+        insort(self.ranking, total)
+        self.best_windows[drone] = total
+        pos, delay = self._rank(self.ranking, total)
+        return pos, delay / self.NANOSECONDS
+
+    def amend(self, drone, lap, amount):
+        """Add time to the passages of a drone that happened since the end
+        of a lap and rank the drone again on its best consecutive laps.
+
+        Parameters:
+          - drone: the ordering index of the drone
+          - lap: the lap whose time is modified, as numbered by the console
+          - amount: the quantity of seconds to add to this lap
+
+        Return the ranking of the drone and its delay on the leading drone
+        (or advance on the second), or (-1, 0) if it did not clear enough
+        laps to be ranked.
+        """
+        super().amend(drone, lap, amount)
+        laps = self.laps.get(drone, [])
+        index = lap - 1 - self.skipped.get(drone, 0)
+        if not 0 <= index < len(laps):
+            return -1, 0
+        amount = round(amount * self.NANOSECONDS)
+        # Later laps are measured on raw times, the penalty is only
+        # accounted for in the amended one
+        laps[index] += amount
+        if len(laps) < self.consecutive:
+            return -1, 0
+        # Every window holding the amended lap changed
+        self.sums[drone] = sum(laps[-self.consecutive:])
+        best = total = sum(laps[:self.consecutive])
+        for last in range(self.consecutive, len(laps)):
+            total += laps[last] - laps[last-self.consecutive]
+            best = min(best, total)
+        return self._improve(drone, best)
+
+    def best_time(self, drone, laps):
+        """Return the best time of a drone over consecutive laps, or None
+        if it did not clear enough laps.
+
+        Parameters:
+          - drone: the ordering index of the drone
+          - laps: the times of the laps cleared by the drone
+        """
+        best = self.best_windows.get(drone)
+        return None if best is None else best / self.NANOSECONDS
+
+
 class FreeForAll(Rules):
     """Custom set of rules that does not enforce a specific ordering
     of the gates during the race.
@@ -478,7 +1301,7 @@ class FreeForAll(Rules):
         """Create a route and check its validity.
 
         Parameters:
-          - timeout: allotted time to clear the race
+          - timeout: allotted time, in seconds, to clear the race
           - strict: should be `True` but is not enforced
           - nb_laps: not used
           - gates: list of 4-items-sequences defining the active gates for
@@ -488,11 +1311,10 @@ class FreeForAll(Rules):
               - number of points associated to this gate
               - identification letter(s) for the next gate after this one
         """
-        # Account for the fact that the timer counts in tenths of seconds
-        # and the timeout value is given in seconds
-        self.timeout = timeout * 10 or None
+        self.timeout = timeout or None
         self.strict = True
         self.nb_laps = None
+        self.penalties = {}
         # Check the route validity
         gates_type = [v[1] for v in gates]
         # Check that there is at most one starting mark
@@ -534,11 +1356,11 @@ class FreeForAll(Rules):
         type, pts = gate['type'], gate['pts']
         # Check if it is the first time this drone goes through the start mark
         start = previous is None and Gates(type).is_start
-        # Compute points
+        # Compute points, time gates grant them per tenth of second remaining
         remaining = self.timeout - time if self.timeout is not None else 0
         running = remaining >= 0
         if previous != gate and running:
-            pts = pts if Gates(type).is_points else remaining*pts
+            pts = pts if Gates(type).is_points else int(remaining*10)*pts
         else:
             pts = 0
         # Update registered points and compute position
@@ -547,3 +1369,28 @@ class FreeForAll(Rules):
         pos = sorted(self.points.values()).index(total)
         return pts, pos+1, 0.0, False, running, start
 
+    def _reset(self):
+        """Forget everything recorded about the progress of a race."""
+        self.penalties = {}
+        self.points = {}
+
+    def amend(self, drone, lap, amount):
+        """Time of passages is not relevant in unordered mode.
+
+        Return (-1, 0) as the ranking of the drone does not change.
+        """
+        return -1, 0
+
+    def add_points(self, drone, amount):
+        """Account for points given by the judges to a drone.
+
+        Parameters:
+          - drone: the ordering index of the drone
+          - amount: the quantity of points added
+
+        Return the new ranking of the drone.
+        """
+        total = self.points.get(drone, 0) + amount
+        self.points[drone] = total
+        return sorted(self.points.values()).index(total) + 1
+
@@ -0,0 +1,138 @@
+"""Append-only journal of the events processed by a console.
+
+Every event that changes the state of a race is appended to a file
+as soon as it is accepted so that the race can be rebuilt after a
+crash of the application. Writes are buffered and synchronized to
+the disk by batches to avoid paying an fsync per passage.
+
+The journal periodically stores a snapshot of the whole state of
+the race and drops the events it accounts for, so that recovering
+only means replaying the few events recorded since then.
+"""
+
+
+import os
+import pickle
+from threading import Lock, Timer
+
+from .i18n import translations
+
+
+_, _N = translations('utils')
+
+
+class JournalError(Exception):
+    """Exception raised when the journal can not be written to."""
+    pass
+
+
+class Journal:
+    """Append-only file storing the events of a race."""
+
+    def __init__(self, filename, batch_size=32, batch_delay=0.05,
+                 snapshot_every=256):
+        """Open the journal for appending.
+
+        Parameters:
+          - filename: path to the file storing the events
+          - batch_size: maximum amount of events kept in memory before
+            forcing them to the disk
+          - batch_delay: maximum amount of seconds an event can be kept in
+            memory before forcing it to the disk
+          - snapshot_every: amount of events after which the console
+            should store a snapshot of its state
+        """
+        self.filename = filename
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.snapshot_every = snapshot_every
+        self.since_snapshot = 0
+        self._pending = 0
+        self._timer = None
+        self._lock = Lock()
+        try:
+            self._file = open(filename, 'ab')
+        except OSError as e:
+            raise JournalError(*e.args)
+
+    def write(self, *event):
+        """Append an event to the journal.
+
+        Parameter:
+          - event: the name of the event followed by its arguments
+        """
+        with self._lock:
+            pickle.dump(event, self._file, pickle.HIGHEST_PROTOCOL)
+            self.since_snapshot += 1
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._sync()
+            elif self._timer is None:
+                self._timer = Timer(self.batch_delay, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def snapshot(self, state):
+        """Replace the content of the journal by a snapshot of the state
+        of the race. Events already recorded are dropped.
+
+        Parameter:
+          - state: a picklable representation of the state of the race
+        """
+        temporary = self.filename + '.tmp'
+        with self._lock:
+            with open(temporary, 'wb') as f:
+                pickle.dump(('snapshot', state), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(temporary, self.filename)
+            self._file = open(self.filename, 'ab')
+            self.since_snapshot = 0
+            self._pending = 0
+
+    def sync(self):
+        """Force pending events to the disk."""
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        """Force pending events to the disk. The lock must be held."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending and not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self):
+        """Force pending events to the disk and close the journal."""
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def read(self):
+        """Return the last snapshot stored in the journal (or None) and the
+        list of events recorded since then.
+
+        A truncated event at the end of the file, resulting from a crash
+        while it was written, is ignored.
+        """
+        state, events = None, []
+        with self._lock:
+            self._file.flush()
+            with open(self.filename, 'rb') as f:
+                while True:
+                    try:
+                        event = pickle.load(f)
+                    except EOFError:
+                        break
+                    except (pickle.UnpicklingError, ValueError,
+                            AttributeError, IndexError):
+                        break
+                    if event[0] == 'snapshot':
+                        state, events = event[1], []
+                    else:
+                        events.append(event)
+        return state, events
@@ -0,0 +1,176 @@
+"""Durable queue of the messages waiting to be delivered to the REST API.
+
+Messages are stored in an SQLite database until the server acknowledges
+them, so that spectators eventually get the whole feed even if the
+network was down for a while or if the application was restarted.
+
+Several outboxes, one per server the messages are delivered to, can
+share the same database. Messages are organised in lanes (usually one
+per track) that are delivered independently of each other, in the
+order they were queued.
+While a lane is stuck, batches of drone statuses queued after its head
+are merged together so that only the latest status of each drone is
+replayed when the server comes back.
+"""
+
+
+import sqlite3
+import sys
+from threading import Lock
+
+from .i18n import translations
+from .serializer import JSONSerializer, BinarySerializer
+
+
+_, _N = translations('utils')
+
+
+class OutboxError(Exception):
+    """Exception raised when the outbox can not be opened."""
+    pass
+
+
+class Outbox:
+    """Bounded, persistent, FIFO queue of messages."""
+
+    def __init__(self, filename=':memory:', sink='', capacity=10000):
+        """Open or create the queue.
+
+        Parameters:
+          - filename: path to the SQLite database storing the messages;
+            messages are only kept in memory by default
+          - sink: name of the server the messages are delivered to
+          - capacity: maximum amount of messages stored; the oldest batches
+            of drone statuses are dropped first when it is exceeded
+        """
+        self.sink = sink
+        self.capacity = capacity
+        self._lock = Lock()
+        # Messages are stored encoded, as text or as bytes
+        self._serializers = {
+            str: JSONSerializer(),
+            bytes: BinarySerializer(),
+        }
+        try:
+            self._conn = sqlite3.connect(filename, check_same_thread=False)
+            # Messages are queued by the threads of the race, keep it cheap
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            with self._conn:
+                self._conn.execute(
+                        'CREATE TABLE IF NOT EXISTS messages ('
+                        'id integer PRIMARY KEY AUTOINCREMENT, '
+                        'sink text NOT NULL, '
+                        'lane text, '
+                        'verb text NOT NULL, '
+                        'path text NOT NULL, '
+                        'body text NOT NULL)')
+            self._size, = self._conn.execute(
+                    'SELECT COUNT(*) FROM messages WHERE sink=?',
+                    (sink,)).fetchone()
+        except sqlite3.DatabaseError as e:
+            raise OutboxError(*e.args)
+
+    def __len__(self):
+        """Amount of messages waiting to be delivered."""
+        return self._size
+
+    def lanes(self):
+        """Return the lanes having messages waiting to be delivered."""
+        with self._lock:
+            return [lane for lane, in self._conn.execute(
+                    'SELECT DISTINCT lane FROM messages WHERE sink=?',
+                    (self.sink,))]
+
+    def put(self, lane, verb, path, body):
+        """Store a message at the end of a lane.
+
+        Parameters:
+          - lane: name of the lane the message is delivered on
+          - verb: HTTP verb used to deliver the message
+          - path: URL of the target page, relative to the API
+          - body: content of the message, encoded by a serializer
+        """
+        with self._lock, self._conn:
+            if path == 'update/' and self._merge(lane, body):
+                return
+            if self._size >= self.capacity:
+                self._drop()
+            self._conn.execute(
+                    'INSERT INTO messages(sink, lane, verb, path, body) '
+                    'VALUES (?,?,?,?,?)',
+                    (self.sink, lane, verb, path, body))
+            self._size += 1
+
+    def _merge(self, lane, body):
+        """Merge a batch of drone statuses into the last message of a lane
+        if it is also a batch of statuses and is not about to be sent.
+        The lock must be held.
+
+        Return whether or not the batch has been merged.
+        """
+        rows = self._conn.execute(
+                'SELECT id, path, body FROM messages '
+                'WHERE sink=? AND lane IS ? ORDER BY id DESC LIMIT 2',
+                (self.sink, lane)).fetchall()
+        # The head of the lane may be in flight
+        if len(rows) < 2 or rows[0][1] != 'update/':
+            return False
+        id, path, previous = rows[0]
+        serializer = self._serializers.get(type(body))
+        if serializer is None or type(previous) is not type(body):
+            return False
+        previous = serializer.loads(previous)
+        args = serializer.loads(body)
+        if previous.get('id_course') != args.get('id_course'):
+            return False
+        drones = {drone['id']: drone for drone in previous['drones']}
+        drones.update((drone['id'], drone) for drone in args['drones'])
+        merged = dict(args, drones=list(drones.values()))
+        self._conn.execute(
+                'UPDATE messages SET body=? WHERE id=?',
+                (serializer.dumps(path, merged), id))
+        return True
+
+    def _drop(self):
+        """Make room for a new message. The lock must be held."""
+        row = self._conn.execute(
+                'SELECT id FROM messages WHERE sink=? AND path=? '
+                'ORDER BY id LIMIT 1', (self.sink, 'update/')).fetchone()
+        if row is None:
+            row = self._conn.execute(
+                    'SELECT id FROM messages WHERE sink=? '
+                    'ORDER BY id LIMIT 1', (self.sink,)).fetchone()
+        print(_('REST outbox full, dropping a message'), file=sys.stderr)
+        self._conn.execute('DELETE FROM messages WHERE id=?', row)
+        self._size -= 1
+
+    def head(self, lane):
+        """Return the oldest message of a lane as a 4-items-tuple (id, verb,
+        path, body) or None if the lane is empty.
+
+        Parameter:
+          - lane: name of the lane
+        """
+        with self._lock:
+            row = self._conn.execute(
+                    'SELECT id, verb, path, body FROM messages '
+                    'WHERE sink=? AND lane IS ? ORDER BY id LIMIT 1',
+                    (self.sink, lane)).fetchone()
+        return row
+
+    def remove(self, id):
+        """Forget a message once it has been delivered.
+
+        Parameter:
+          - id: identifier of the message, as returned by `head`
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                    'DELETE FROM messages WHERE id=?', (id,))
+            self._size -= cursor.rowcount
+
+    def close(self):
+        """Close the underlying database. Undelivered messages are kept."""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,348 @@
+"""Collection of classes telling the outside world about the progress
+of races.
+
+Consoles and the GUI only know about the interface of `BasePublisher`:
+setup of a race, warm-up texts, batches of drone statuses, end or
+cancelation of a race and final leader-board. Each publisher decides
+how and to whom these messages are delivered:
+  - RESTPublisher sends them to the REST API servers configured in the
+    `rest` module;
+  - MulticastPublisher broadcasts them as UDP datagrams on the LAN, so
+    that any number of displays can follow the races without costing
+    anything more than a single datagram per message;
+  - SpectatorPublisher runs the spectator server of `local_server` in
+    this very process and feeds its WebSockets directly;
+  - PublisherGroup forwards them to several publishers at once.
+"""
+
+
+import sys
+import socket
+import traceback
+from threading import Lock
+from time import time
+
+from . import rest
+from .serializer import JSONSerializer, BinarySerializer
+from .i18n import translations
+try:
+    from local_server import webserver
+except ImportError:
+    webserver = None
+
+
+_, _N = translations('utils')
+
+
+class BasePublisher:
+    """Base class for custom publishers."""
+
+    def setup(self, game_name, rules, *people, track=None, race=None):
+        """Tell about a new race that is likely to be started soon.
+        Subclasses must implement this method.
+
+        Parameters:
+          - game_name: name for the route and custom rules of the race
+          - rules: the Rules object owning the rules of the race
+          - people: informations on the drivers of the race
+          - track: name of the track the race takes place on, if any
+          - race: identification of the race in the database, if any
+        """
+        raise NotImplementedError(_("Subclasses must implement this method"))
+
+    def warmup(self, text, start, track=None):
+        """Tell that a race is being started and provide a text to display.
+        Subclasses must implement this method.
+        """
+        raise NotImplementedError(_("Subclasses must implement this method"))
+
+    def updates(self, drones, track=None):
+        """Tell that several drones had their status changed.
+        Subclasses must implement this method.
+
+        Parameters:
+          - drones: latest status of each drone that changed
+          - track: name of the track the race takes place on, if any
+        """
+        raise NotImplementedError(_("Subclasses must implement this method"))
+
+    def cancel(self, track=None):
+        """Tell that a race has been canceled.
+        Subclasses must implement this method.
+        """
+        raise NotImplementedError(_("Subclasses must implement this method"))
+
+    def finish(self, track=None):
+        """Tell that a race just finished; its leader-board may still change.
+        Subclasses must implement this method.
+        """
+        raise NotImplementedError(_("Subclasses must implement this method"))
+
+    def leaderboard(self, *drones, track=None):
+        """Provide the final leader-board of a race.
+        Subclasses must implement this method.
+        """
+        raise NotImplementedError(_("Subclasses must implement this method"))
+
+    def shutdown(self, timeout=5):
+        """Deliver the messages still pending and release the resources
+        of the publisher.
+
+        Parameter:
+          - timeout: maximum amount of seconds to wait for pending messages
+        """
+        pass
+
+
+class RESTPublisher(BasePublisher):
+    """Send messages to the REST API servers configured in the `rest`
+    module. See its functions for the content of the messages.
+    """
+
+    def setup(self, game_name, rules, *people, track=None, race=None):
+        rest.setup(game_name, rules, *people, track=track, race=race)
+
+    def warmup(self, text, start, track=None):
+        rest.warmup(text, start, track)
+
+    def updates(self, drones, track=None):
+        rest.updates(drones, track)
+
+    def cancel(self, track=None):
+        rest.cancel(track)
+
+    def finish(self, track=None):
+        rest.finish(track)
+
+    def leaderboard(self, *drones, track=None):
+        rest.leaderboard(*drones, track=track)
+
+    def shutdown(self, timeout=5):
+        rest.shutdown(timeout)
+
+
+class MulticastPublisher(BasePublisher):
+    """Broadcast messages as UDP datagrams to a multicast group.
+
+    Datagrams are encoded with the binary (MessagePack) serializer and
+    are never retried: displays must cope with lost messages, which is
+    mostly harmless since each batch holds the full status of the drones
+    it is about.
+    """
+    """MessagePack
+    Every datagram holds a map with the following keys:
+     - action: string
+            -> 'setup', 'warmup', 'updates', 'cancel', 'finish' or
+                'leaderboard'
+     - piste: string or nil
+            -> name of the track the race takes place on
+     - sequence: number
+            -> rank of the datagram among the ones sent about the track;
+                datagrams received with a lower rank are outdated
+    plus the keys of the matching object documented in the `rest` module
+    (Setup, Warm-up, Update or Leader-board objects). Batches of drones
+    too large for a single datagram are split into several 'updates' or
+    'leaderboard' datagrams.
+    """
+
+    def __init__(self, group='239.255.43.87', port=4388, ttl=1,
+                 max_size=1400):
+        """Open the socket sending the datagrams.
+
+        Parameters:
+          - group: IPv4 address of the multicast group
+          - port: UDP port the displays listen on
+          - ttl: amount of routers the datagrams may go through; 1 keeps
+            them on the local network
+          - max_size: maximum size of a datagram, in bytes, to avoid IP
+            fragmentation
+        """
+        self.address = (group, port)
+        self.max_size = max_size
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self._serializer = BinarySerializer()
+        self._sequences = {}
+        # Protect the sequences and the buffer of the serializer
+        self._lock = Lock()
+
+    def _send(self, action, track, path='', **message):
+        """Encode a message and send it as one or more datagrams.
+
+        Parameters:
+          - action: kind of message
+          - track: name of the track the race takes place on
+          - path: schema of the message, as known by the serializer
+          - message: content of the message
+        """
+        message['action'] = action
+        message['piste'] = track
+        with self._lock:
+            for datagram in self._encode(path, message):
+                try:
+                    self.socket.sendto(datagram, self.address)
+                except OSError as e:
+                    print(_('Multicast of {} failed:').format(action),
+                          file=sys.stderr)
+                    for pretty_print in traceback.format_exception_only(
+                            type(e), e):
+                        print(pretty_print, file=sys.stderr)
+                    return
+
+    def _encode(self, path, message):
+        """Return the datagrams holding a message, splitting its drones
+        among several of them if needed. The lock must be held.
+        """
+        track = message['piste']
+        sequence = self._sequences.get(track) or int(time() * 1000)
+        self._sequences[track] = sequence + 1
+        message['sequence'] = sequence
+        datagram = self._serializer.dumps(path, message)
+        drones = message.get('drones')
+        if len(datagram) <= self.max_size or not drones or len(drones) < 2:
+            return [datagram]
+        # Number the parts instead of the whole message
+        self._sequences[track] = sequence
+        half = len(drones) // 2
+        return (self._encode(path, dict(message, drones=drones[:half])) +
+                self._encode(path, dict(message, drones=drones[half:])))
+
+    def setup(self, game_name, rules, *people, track=None, race=None):
+        course = rules.get_setup()
+        course['nom'] = game_name
+        self._send('setup', track, pilotes=people, course=course,
+                   id_course=race)
+
+    def warmup(self, text, start, track=None):
+        self._send('warmup', track, texte=text, start=start)
+
+    def updates(self, drones, track=None):
+        self._send('updates', track, 'update/', drones=drones)
+
+    def cancel(self, track=None):
+        self._send('cancel', track)
+
+    def finish(self, track=None):
+        self._send('finish', track)
+
+    def leaderboard(self, *drones, track=None):
+        self._send('leaderboard', track, 'leaderboard/', drones=drones)
+
+    def shutdown(self, timeout=5):
+        self.socket.close()
+
+
+class SpectatorPublisher(BasePublisher):
+    """Run the spectator server of `local_server` on its own thread and
+    hand it the messages directly, without going through HTTP.
+    Messages are encoded once, the way the server would have built them
+    from the corresponding REST requests, and broadcast on the channel
+    of their track.
+    """
+
+    def __init__(self, port=None):
+        """Start the server.
+
+        Parameter:
+          - port: the port spectators connect to; defaults to the one of
+            the local_server settings
+        """
+        self._serializer = JSONSerializer()
+        self._lock = Lock()
+        if webserver is None:
+            print(_('Can not load tornado module. '
+                    'Spectators will not be served'), file=sys.stderr)
+        else:
+            webserver.start_in_thread(port)
+
+    def _send(self, action, track, path='', **message):
+        """Encode a message and queue it on the IOLoop of the server.
+
+        Parameters:
+          - action: kind of message
+          - track: name of the track the race takes place on
+          - path: schema of the message, as known by the serializer
+          - message: content of the message
+        """
+        if webserver is None:
+            return
+        if track is not None:
+            message['piste'] = track
+        with self._lock:
+            data = None
+            # The server computes itself what changed in batches of
+            # drones; other messages are encoded once for every spectator
+            if action != 'updates':
+                data = self._serializer.dumps(path, message)
+            # Queue while holding the lock to keep messages in order
+            webserver.broadcast(action, data, message, track)
+
+    def setup(self, game_name, rules, *people, track=None, race=None):
+        course = rules.get_setup()
+        course['nom'] = game_name
+        self._send('setup', track, pilotes=people, course=course,
+                   id_course=race)
+
+    def warmup(self, text, start, track=None):
+        self._send('warmup', track, texte=text, start=start)
+
+    def updates(self, drones, track=None):
+        self._send('updates', track, 'update/', drones=drones)
+
+    def cancel(self, track=None):
+        self._send('cancel', track)
+
+    def finish(self, track=None):
+        self._send('finish', track)
+
+    def leaderboard(self, *drones, track=None):
+        self._send('leaderboard', track, 'leaderboard/', drones=drones)
+
+    def shutdown(self, timeout=5):
+        if webserver is not None:
+            webserver.stop()
+
+
+class PublisherGroup(BasePublisher):
+    """Forward messages to several publishers, in order."""
+
+    def __init__(self, *publishers):
+        """Gather publishers.
+
+        Parameter:
+          - publishers: the BasePublisher objects to forward messages to
+        """
+        self.publishers = list(publishers)
+
+    def add(self, publisher):
+        """Forward messages to one more publisher."""
+        self.publishers.append(publisher)
+
+    def setup(self, game_name, rules, *people, track=None, race=None):
+        for publisher in self.publishers:
+            publisher.setup(game_name, rules, *people, track=track, race=race)
+
+    def warmup(self, text, start, track=None):
+        for publisher in self.publishers:
+            publisher.warmup(text, start, track)
+
+    def updates(self, drones, track=None):
+        for publisher in self.publishers:
+            publisher.updates(drones, track)
+
+    def cancel(self, track=None):
+        for publisher in self.publishers:
+            publisher.cancel(track)
+
+    def finish(self, track=None):
+        for publisher in self.publishers:
+            publisher.finish(track)
+
+    def leaderboard(self, *drones, track=None):
+        for publisher in self.publishers:
+            publisher.leaderboard(*drones, track=track)
+
+    def shutdown(self, timeout=5):
+        for publisher in self.publishers:
+            publisher.shutdown(timeout)
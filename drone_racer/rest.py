@@ -1,7 +1,9 @@
-from requests import request, RequestException
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from local_server import *
-from threading import Thread
+from threading import Thread, Lock, RLock, Timer, Condition
+from time import monotonic, time
 from sys import stderr
 import traceback
 try:
@@ -10,56 +12,421 @@ except ImportError:
     import json
 
 from .i18n import translations
+from .outbox import Outbox
+from .serializer import JSONSerializer, BinarySerializer, BINARY_CONTENT_TYPE
 
 
 _, _N = translations('utils')
 
 # Default address for the server providing the REST API
 _REST_ADDR = 'http://localhost/'
+# Amount of seconds during which statuses of drones are gathered before
+# being sent as a single batch
+_FLUSH_INTERVAL = 0.1
 
 
-def _execute_request(verb, path, **kwargs):
-    """Send an HTTP request to the REST API.
+class Publisher:
+    """Pool of threads sending requests to a server providing the REST
+    API. Every thread shares the same HTTP session so that connections
+    are kept alive and reused between requests.
+
+    Requests are stored in an outbox until the server acknowledges them.
+    Each lane of the outbox is bound to a thread that sends its requests
+    one after the other, retrying the oldest one with an increasing
+    delay when the server can not be reached.
+
+    Each server gets its own publisher so that a slow or unreachable
+    one does not delay the delivery of messages to the others.
+    """
+
+    def __init__(self, address, outbox=None, workers=1, timeout=15,
+                 backoff=0.5, max_backoff=30, binary=False):
+        """Start the threads of the pool.
+
+        Parameters:
+          - address: web address of the REST API
+          - outbox: the Outbox object storing the requests to send; they
+            are only kept in memory by default
+          - workers: amount of requests that can be sent simultaneously
+          - timeout: amount of seconds to wait for the server to answer
+          - backoff: amount of seconds to wait before the first retry of
+            a failed request
+          - max_backoff: maximum amount of seconds between two retries
+          - binary: whether the server accepts messages in the binary
+            format of the serializer module instead of JSON
+        """
+        self.address = address
+        self.binary = binary
+        self.outbox = Outbox(sink=address) if outbox is None else outbox
+        self.workers = workers
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Health of the server, as seen by the last requests
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+        self._lanes = [[] for _ in range(workers)]
+        self._assigned = {}
+        self._running = True
+        self._stopped = 0
+        self._wakeup = Condition()
+        self._session = Session()
+        self._session.auth = HTTPBasicAuth(basic_user, basic_password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        # Replay requests left over by a previous run
+        for lane in self.outbox.lanes():
+            self._assign(lane)
+        self._workers = [
+                Thread(target=self._work, name='rest-{}-{}'.format(
+                    address, i),
+                    args=(lanes,), daemon=True)
+                for i, lanes in enumerate(self._lanes)]
+        for worker in self._workers:
+            worker.start()
+
+    def _assign(self, lane):
+        """Bind a lane to one of the threads. The lock must be held."""
+        if lane not in self._assigned:
+            lanes = self._lanes[len(self._assigned) % len(self._lanes)]
+            lanes.append(lane)
+            self._assigned[lane] = lanes
+
+    def send(self, lane, verb, path, body):
+        """Queue an HTTP request to the REST API.
+
+        Parameters:
+          - lane: key of the messages that must be delivered in order
+            (e.g. the name of the track)
+          - verb: HTTP verb to use for the request (mainly 'GET' and 'POST')
+          - path: URL of the target page, relative to the API
+          - body: POST data or query parameters, encoded by the serializer
+            matching the format of the server (query parameters are
+            always encoded as JSON)
+        """
+        self.outbox.put(lane, verb, path, body)
+        with self._wakeup:
+            self._assign(lane)
+            self._wakeup.notify_all()
+
+    def _work(self, lanes):
+        """Send the requests of some lanes until the publisher is shut
+        down.
+        """
+        delay = 0
+        while self._running:
+            with self._wakeup:
+                heads = [self.outbox.head(lane) for lane in lanes]
+            heads = [head for head in heads if head is not None]
+            failed = False
+            for id, verb, path, body in heads:
+                if not self._running:
+                    break
+                if self._execute(verb, path, body):
+                    self.outbox.remove(id)
+                else:
+                    failed = True
+            with self._wakeup:
+                if failed:
+                    # Back off, even if new requests are queued meanwhile
+                    delay = min(max(delay * 2, self.backoff), self.max_backoff)
+                    retry = monotonic() + delay
+                    while self._running and monotonic() < retry:
+                        self._wakeup.wait(retry - monotonic())
+                elif heads:
+                    delay = 0
+                    # Let shutdown know about the progress
+                    self._wakeup.notify_all()
+                elif not any(self.outbox.head(lane) for lane in lanes):
+                    self._wakeup.wait()
+        self._release()
+
+    def _release(self):
+        """Close the session and the outbox once every thread stopped, so
+        that a request still in flight at shutdown can be acknowledged.
+        """
+        with self._wakeup:
+            self._stopped += 1
+            if self._stopped < len(self._lanes):
+                return
+        self._session.close()
+        self.outbox.close()
+
+    def _execute(self, verb, path, body):
+        """Send an HTTP request to the REST API.
+
+        Return whether or not the request does not need to be sent again.
+        """
+        if verb != 'POST':
+            kwargs = {'params': json.loads(body)}
+        elif self.binary:
+            kwargs = {
+                'data': body,
+                'headers': {'Content-Type': BINARY_CONTENT_TYPE},
+            }
+        else:
+            kwargs = {'data': {'data': body}}
+        try:
+            response = self._session.request(
+                    verb, self.address + path, timeout=self.timeout, **kwargs)
+        except RequestException as e:
+            self._failed(path, ''.join(
+                    traceback.format_exception_only(type(e), e)).strip())
+            return False
+        # Server errors may be temporary, others will not go away
+        if response.status_code >= 500:
+            self._failed(path, _('status {}').format(response.status_code))
+            return False
+        if not self.healthy:
+            print(_('REST API {} is reachable again').format(self.address),
+                  file=stderr)
+        self.healthy = True
+        self.failures = 0
+        if response.status_code >= 400:
+            print(_('REST request {} failed with status {}').format(
+                    path[:-1], response.status_code), file=stderr)
+        return True
+
+    def _failed(self, path, error):
+        """Keep track of a request that will be sent again. Only the first
+        failure is reported so that an unreachable server does not flood
+        the console while requests are retried.
+        """
+        self.failures += 1
+        self.last_error = error
+        if self.healthy:
+            print(_('REST request {} to {} failed: {}').format(
+                    path[:-1], self.address, error), file=stderr)
+        self.healthy = False
+
+    def shutdown(self, timeout=5):
+        """Wait for the pending requests to be sent and stop the threads.
+        Requests that could not be sent are kept in the outbox.
+
+        Parameter:
+          - timeout: maximum amount of seconds to wait for pending requests
+        """
+        deadline = monotonic() + timeout
+        with self._wakeup:
+            while len(self.outbox):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._wakeup.wait(remaining)
+            self._running = False
+            self._wakeup.notify_all()
+        for worker in self._workers:
+            worker.join(max(deadline - monotonic(), 0))
+
+
+# Servers the messages are delivered to: amount of simultaneous requests
+# and timeout, by address
+_endpoints = {_REST_ADDR: (1, 15, False)}
+# Publishers delivering the messages to these servers, started on demand
+_publishers = {}
+_publishers_lock = Lock()
+# Encoders of the messages, by format (binary or not); only used while
+# holding the lock of the streams
+_serializers = {False: JSONSerializer(), True: BinarySerializer()}
+# Database storing the messages that were not delivered yet
+_outbox_file = ':memory:'
+# Latest status of the drones changed since the last batch, per track
+_pending = {}
+_pending_lock = Lock()
+_flush_timer = None
+# Identification of the current race and amount of messages sent about
+# it, per track; the lock is held from the moment a batch of statuses
+# is taken until it is numbered, so that batches can not overtake each
+# other nor the messages sent after them
+_streams = {}
+_streams_lock = RLock()
+
+
+def _get_publishers():
+    """Return the publishers sending requests, starting them if needed.
+    The lock must be held.
+    """
+    for address in _endpoints:
+        if address not in _publishers:
+            _publishers[address] = _start(
+                    address, Outbox(_outbox_file, address))
+    return _publishers
+
+def _start(address, outbox):
+    """Create the publisher of a configured server."""
+    workers, timeout, binary = _endpoints[address]
+    return Publisher(address, outbox, workers, timeout, binary=binary)
+
+def endpoints():
+    """Return the Publisher objects delivering messages to each server
+    providing the REST API. Their `healthy`, `failures` and `last_error`
+    attributes describe how the delivery goes.
+    """
+    with _publishers_lock:
+        return list(_get_publishers().values())
+
+def add_endpoint(address, timeout=15, workers=1, binary=False):
+    """Deliver the messages sent from now on to one more server.
 
     Parameters:
-        verb: HTTP verb to use for the request (mainly 'GET' and 'POST').
-        path: URL of the target page.
-        kwargs: extra arguments for the request such as POST data or timeout.
+      - address: web address of the REST API
+      - timeout: amount of seconds to wait for the server to answer
+      - workers: amount of requests that can be sent simultaneously
+      - binary: whether the server accepts messages in the binary format
+        of the serializer module instead of JSON
+    """
+    with _publishers_lock:
+        _endpoints.setdefault(address, (workers, timeout, binary))
+
+def remove_endpoint(address):
+    """Stop delivering messages to a server. Messages that were not
+    delivered yet are kept in the outbox in case it is added back later.
+
+    Parameter:
+      - address: web address of the REST API
     """
-    kwargs.update({'auth': HTTPBasicAuth(basic_user, basic_password)})
-    try:
-        request(verb, _REST_ADDR + path, **kwargs)
-    except RequestException as e:
-        print(_('REST request {} failed:').format(path[:-1]), file=stderr)
-        for pretty_print in traceback.format_exception_only(type(e), e):
-            print(pretty_print, file=stderr)
+    with _publishers_lock:
+        _endpoints.pop(address, None)
+        publisher = _publishers.pop(address, None)
+    if publisher is not None:
+        publisher.shutdown(0)
 
-def _do_request(path, args=None):
-    """Execute a request on a separate thread to avoid waiting on I/O.
+def set_endpoints(addresses):
+    """Deliver the messages to the given servers only.
+
+    Parameter:
+      - addresses: web addresses of the REST APIs
+    """
+    for address in list(_endpoints):
+        if address not in addresses:
+            remove_endpoint(address)
+    for address in addresses:
+        add_endpoint(address)
+
+def _hand_over(publisher, replacement):
+    """Move the requests still pending from a publisher to another one
+    and stop the former.
+    """
+    for lane in publisher.outbox.lanes():
+        head = publisher.outbox.head(lane)
+        while head is not None:
+            id, verb, path, body = head
+            publisher.outbox.remove(id)
+            replacement.send(lane, verb, path, body)
+            head = publisher.outbox.head(lane)
+    publisher.shutdown(0)
+
+def use_outbox(filename):
+    """Store the requests that were not delivered yet in a file so that
+    they are sent even after a restart of the application. Requests left
+    in the file by a previous run are sent again.
+
+    Parameter:
+      - filename: path to the SQLite database storing the requests
+    """
+    global _outbox_file
+    with _publishers_lock:
+        if filename == _outbox_file:
+            # Replay the requests left over, if not already done
+            _get_publishers()
+            return
+        # Open every outbox first so that errors leave things untouched
+        outboxes = {address: Outbox(filename, address)
+                    for address in _endpoints}
+        _outbox_file = filename
+        replaced = []
+        for address, outbox in outboxes.items():
+            publisher = _start(address, outbox)
+            if address in _publishers:
+                replaced.append((_publishers[address], publisher))
+            _publishers[address] = publisher
+    for publisher, replacement in replaced:
+        _hand_over(publisher, replacement)
+
+def shutdown(timeout=5):
+    """Send the requests still pending and release the connections to
+    the REST APIs.
+
+    Parameter:
+      - timeout: maximum amount of seconds to wait for pending requests
+    """
+    flush()
+    with _publishers_lock:
+        publishers = list(_publishers.values())
+        _publishers.clear()
+    if publishers:
+        # Servers are waited for simultaneously, each one for the whole
+        # timeout, so that an unreachable one does not hold the others
+        threads = [Thread(target=publisher.shutdown, args=(timeout,))
+                   for publisher in publishers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+def _first_sequence():
+    """Return the sequence number of the first message sent about a track.
+    Based on the wall-clock so that numbers keep increasing when a race
+    is resumed after a restart of the application.
+    """
+    return int(time() * 1000)
+
+def _do_request(path, args=None, track=None):
+    """Queue a request to be sent by the pool of threads to avoid waiting
+    on I/O.
 
     Parameters:
         path: URL of the target page.
-        args: POST data for the page that will be json encoded.
-    """
-    if args:
-        thread = Thread(target=_execute_request,
-                name='rest-post',
-                args=('POST', path),
-                kwargs={'timeout':15, 'data':{'data':json.dumps(args)}})
-    else:
-        thread = Thread(target=_execute_request,
-                name='rest-get',
-                args=('GET', path),
-                kwargs={'timeout':15})
-    thread.start()
-
-def setup(game_name, rules, *people):
+        args: POST data for the page that will be encoded once for each
+            format accepted by the servers.
+        track: name of the track the race takes place on, if any.
+    """
+    """JSON
+    Every message also holds, in its POST data or its query parameters:
+     - id_course: number or null
+            -> identification of the race the message is about
+     - sequence: number
+            -> rank of the message among the ones sent about this race;
+                messages with a lower rank than one already received are
+                outdated
+    """
+    with _publishers_lock:
+        publishers = list(_get_publishers().values())
+    # Numbering and queueing at once keeps messages in sequence order
+    with _streams_lock:
+        stream = _streams.setdefault(track, [None, _first_sequence()])
+        race, sequence = stream
+        stream[1] += 1
+        if args:
+            args = dict(args, id_course=race, sequence=sequence)
+            if track is not None:
+                args['piste'] = track
+            bodies = {}
+            for publisher in publishers:
+                body = bodies.get(publisher.binary)
+                if body is None:
+                    body = _serializers[publisher.binary].dumps(path, args)
+                    bodies[publisher.binary] = body
+                publisher.send(track, 'POST', path, body)
+        else:
+            params = {'id_course': race, 'sequence': sequence}
+            if track is not None:
+                params['piste'] = track
+            params = _serializers[False].dumps(path, params)
+            for publisher in publishers:
+                publisher.send(track, 'GET', path, params)
+
+def setup(game_name, rules, *people, track=None, race=None):
     """Tell the REST API about a new race that is likely to be started soon.
 
     Parameters:
         game_name: name for the route and custom rules used for this race.
         rules: route and custom rules data for this race.
         people: informations on the drivers of this race.
+        track: name of the track the race takes place on, if any.
+        race: identification of the race in the database, if any.
     """
     """JSON
     Setup object:
@@ -68,6 +435,8 @@ def setup(game_name, rules, *people):
             -> drivers for this race
      - course: Race object
             -> rules for this race
+     - piste: string (optional)
+            -> name of the track the race takes place on
 
     Race object:
     ------------
@@ -92,9 +461,12 @@ def setup(game_name, rules, *people):
     setup = rules.get_setup()
     setup.update({'nom': game_name})
     data = {'pilotes': people, 'course': setup}
-    _do_request('setup/', data)
+    with _streams_lock:
+        flush(track)
+        _streams.setdefault(track, [None, _first_sequence()])[0] = race
+        _do_request('setup/', data, track)
 
-def warmup(text, start):
+def warmup(text, start, track=None):
     """Tell the REST API that a race is being started and provide a
     text to display.
     """
@@ -105,12 +477,50 @@ def warmup(text, start):
             -> text to display
      - start: bool
             -> whether the race should be started (timer, leader-board, etc.)
+     - piste: string (optional)
+            -> name of the track the race takes place on
     """
-    _do_request('warmup/', {'texte': text, 'start': start})
+    _do_request('warmup/', {'texte': text, 'start': start}, track)
+
+def flush(track=None):
+    """Send the statuses of drones gathered so far as one batch per track.
+    Called before sending any other message about a track so that these
+    statuses do not end up being sent after it.
+
+    Parameter:
+        track: name of the track whose batch should be sent, or None to
+            send every batch.
+    """
+    global _flush_timer
+    with _streams_lock:
+        with _pending_lock:
+            if track is None:
+                batches = dict(_pending)
+                _pending.clear()
+                if _flush_timer is not None:
+                    _flush_timer.cancel()
+                    _flush_timer = None
+            else:
+                batches = {track: _pending.pop(track, None)}
+        for track, drones in batches.items():
+            if drones:
+                _do_request(
+                        'update/', {'drones': list(drones.values())}, track)
+
+def update(drone, track=None):
+    """Tell the REST API that a drone had its status changed.
 
-def update(drone):
-    """Tell the REST API that a drone had its status changed."""
+    Statuses are gathered during a short interval and sent as a single
+    Update object; only the latest status of each drone is sent.
+    """
     """JSON
+    Update object:
+    --------------
+     - drones: Array of drone objects
+            -> latest status of each drone changed since the previous batch
+     - piste: string (optional)
+            -> name of the track the race takes place on
+
     Drone object:
     -------------
      - id: number
@@ -133,28 +543,59 @@ def update(drone):
      - porte: string or null
             -> identification of the last gate the drone passed by, if relevant
     """
-    _do_request('update/', drone)
+    global _flush_timer
+    with _pending_lock:
+        _pending.setdefault(track, {})[drone['id']] = drone
+        if _flush_timer is None:
+            _flush_timer = Timer(_FLUSH_INTERVAL, _flush_all)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+def _flush_all():
+    """Send every batch of statuses at the end of the gathering interval."""
+    global _flush_timer
+    with _pending_lock:
+        _flush_timer = None
+    flush()
+
+def updates(drones, track=None):
+    """Tell the REST API that several drones had their status changed.
+    Each drone is sent as a Drone object (see `update`).
+    """
+    for drone in drones:
+        update(drone, track)
 
-def cancel():
+def cancel(track=None):
     """Tell the REST API that a race has been canceled."""
     """JSON
-    No data
+    No data, the name of the track is sent in the 'piste' query
+    parameter, if any.
     """
-    _do_request('cancel/')
+    with _streams_lock:
+        flush(track)
+        _do_request('cancel/', track=track)
 
-def finish():
+def finish(track=None):
     """Tell the REST API that a race just finished.
     Leader-board may still change.
     """
     """JSON
-    No data
+    No data, the name of the track is sent in the 'piste' query
+    parameter, if any.
     """
-    _do_request('finish/')
+    with _streams_lock:
+        flush(track)
+        _do_request('finish/', track=track)
 
-def leaderboard(*drones):
+def leaderboard(*drones, track=None):
     """Send the final leader-board to the REST API."""
     """JSON
-    Array of drone objects.
+    Leader-board object:
+    --------------------
+     - drones: Array of drone objects
+            -> final status of each drone
+     - piste: string (optional)
+            -> name of the track the race takes place on
 
     Drone object:
     -------------
@@ -178,5 +619,7 @@ def leaderboard(*drones):
      - porte: string or null
             -> identification of the last gate the drone passed by, if relevant
     """
-    _do_request('leaderboard/', {'drones': drones})
+    with _streams_lock:
+        flush(track)
+        _do_request('leaderboard/', {'drones': drones}, track)
 
@@ -0,0 +1,338 @@
+"""Encoding of the messages sent to the REST API.
+
+Messages follow the fixed schemas documented in the `rest` module
+(Setup, Warm-up, Update and Leader-board objects), most of their weight
+being the Drone objects of the batches of statuses.
+
+JSON text is produced by the compact encoder of the json module, whose
+C implementation is as fast as formatting templates of the drones. The
+binary encoder of the drones is compiled once from the list of their
+fields instead, so that encoding a drone is a single join rather than a
+walk through a generic dictionary. Drones that do not match their schema
+(missing or additional fields, unexpected types) are encoded by the
+generic path.
+
+Two formats are available:
+  - compact JSON, understood by every server;
+  - a binary layout following the MessagePack specification, about half
+    the size of the JSON text, for servers that accept it.
+"""
+
+
+import struct
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from .i18n import translations
+
+
+_, _N = translations('utils')
+
+
+JSON_CONTENT_TYPE = 'application/json'
+BINARY_CONTENT_TYPE = 'application/x-msgpack'
+
+# Fields of a Drone object (see `rest.update`) and their kind:
+#  - int: integral number
+#  - number: number or null
+#  - bool: boolean or null
+#  - string: string or null
+DRONE_FIELDS = (
+    ('id', 'int'),
+    ('position', 'number'),
+    ('points', 'number'),
+    ('temps', 'number'),
+    ('retard', 'number'),
+    ('tour', 'number'),
+    ('finish', 'bool'),
+    ('tours', 'int'),
+    ('porte', 'string'),
+)
+# Key holding the array of Drone objects of each kind of message
+DRONES_KEYS = {
+    'update/': 'drones',
+    'leaderboard/': 'drones',
+}
+
+
+class SerializerError(Exception):
+    """Exception raised when a message can not be decoded."""
+    pass
+
+
+_generic = json.JSONEncoder(separators=(',', ':')).encode
+
+
+class JSONSerializer:
+    """Encoder of messages as compact JSON text."""
+
+    content_type = JSON_CONTENT_TYPE
+    binary = False
+
+    def dumps(self, path, args):
+        """Encode a message.
+
+        Parameters:
+          - path: URL of the target page, telling the schema of the message
+          - args: JSON-ready content of the message
+
+        Return the encoded message as a string.
+        """
+        return _generic(args)
+
+    def loads(self, body):
+        """Decode a message encoded by `dumps`."""
+        return json.loads(body)
+
+
+_FLOAT = struct.Struct('>Bd')
+_NIL = b'\xc0'
+_BOOLS = {None: _NIL, True: b'\xc3', False: b'\xc2'}
+_SMALL_INTS = tuple(bytes((i,)) for i in range(128))
+_HEADERS = {
+    # kind: (fix prefix, fix limit, [(prefix, struct), ...])
+    'str': (0xa0, 32, [(0xd9, '>B'), (0xda, '>H'), (0xdb, '>I')]),
+    'array': (0x90, 16, [(0xdc, '>H'), (0xdd, '>I')]),
+    'map': (0x80, 16, [(0xde, '>H'), (0xdf, '>I')]),
+}
+_UINTS = ((0xcc, 0xff, '>B'), (0xcd, 0xffff, '>H'),
+          (0xce, 0xffffffff, '>I'), (0xcf, 0xffffffffffffffff, '>Q'))
+_INTS = ((0xd0, 0x7f, '>b'), (0xd1, 0x7fff, '>h'),
+         (0xd2, 0x7fffffff, '>i'), (0xd3, 0x7fffffffffffffff, '>q'))
+
+
+def _header(kind, size):
+    """Return the bytes announcing a string, array or map of the given
+    size.
+    """
+    prefix, limit, larger = _HEADERS[kind]
+    if size < limit:
+        return bytes((prefix | size,))
+    for prefix, layout in larger:
+        try:
+            return bytes((prefix,)) + struct.pack(layout, size)
+        except struct.error:
+            continue
+    raise ValueError(_('Object too large to be encoded: {}').format(size))
+
+
+def _pack(value, buffer):
+    """Append any JSON-ready value to a buffer."""
+    if value is None:
+        buffer += _NIL
+    elif value is True or value is False:
+        buffer += _BOOLS[value]
+    elif isinstance(value, int):
+        if -32 <= value < 128:
+            buffer += struct.pack('>b', value)
+            return
+        for prefix, limit, layout in _UINTS if value > 0 else _INTS:
+            if -limit - 1 <= value <= limit:
+                buffer.append(prefix)
+                buffer += struct.pack(layout, value)
+                return
+        buffer += _FLOAT.pack(0xcb, value)
+    elif isinstance(value, float):
+        buffer += _FLOAT.pack(0xcb, value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        buffer += _header('str', len(data))
+        buffer += data
+    elif isinstance(value, dict):
+        buffer += _header('map', len(value))
+        for key, item in value.items():
+            _pack(str(key), buffer)
+            _pack(item, buffer)
+    elif isinstance(value, (list, tuple)):
+        buffer += _header('array', len(value))
+        for item in value:
+            _pack(item, buffer)
+    else:
+        raise TypeError(_('Can not encode {!r}').format(value))
+
+
+def _scalar(value):
+    """Return the encoded form of a single value."""
+    buffer = bytearray()
+    _pack(value, buffer)
+    return bytes(buffer)
+
+
+_BINARY_VALUES = {
+    'int': ('_SMALL_INTS[{0}] if {0}.__class__ is int and 0 <= {0} < 128 '
+            'else _scalar({0})'),
+    'number': ('_NIL if {0} is None else _FLOAT.pack(0xcb, {0}) '
+               'if {0}.__class__ is float else _scalar({0})'),
+    'bool': '_BOOLS[{}]',
+    'string': '_NIL if {0} is None else _scalar({0})',
+}
+
+
+def compile_binary(fields):
+    """Build a function encoding objects made of the given fields in the
+    binary format. Keys are encoded once for all.
+
+    Parameter:
+      - fields: sequence of (name, kind) pairs describing the object
+
+    The returned function raises KeyError or TypeError when an object
+    does not have exactly the given fields.
+    """
+    namespace = {
+        '_NIL': _NIL,
+        '_BOOLS': _BOOLS,
+        '_SMALL_INTS': _SMALL_INTS,
+        '_FLOAT': _FLOAT,
+        '_scalar': _scalar,
+    }
+    lookups, values = [], []
+    for index, (name, kind) in enumerate(fields):
+        key = name.encode('utf-8')
+        key = _header('str', len(key)) + key
+        if not index:
+            key = _header('map', len(fields)) + key
+        namespace['_K{}'.format(index)] = key
+        lookups.append('    v{} = d[{!r}]\n'.format(index, name))
+        values.append('_K{}'.format(index))
+        values.append(_BINARY_VALUES[kind].format('v{}'.format(index)))
+    source = (
+        'def encode(d):\n'
+        '    if len(d) != {}:\n'
+        '        raise KeyError(d)\n'
+        '{}'
+        '    return b"".join(({},))\n'.format(
+            len(fields), ''.join(lookups), ', '.join(values)))
+    exec(source, namespace)
+    return namespace['encode']
+
+
+class BinarySerializer:
+    """Encoder of messages following the MessagePack specification.
+    Every message is built in the same buffer.
+    """
+
+    content_type = BINARY_CONTENT_TYPE
+    binary = True
+
+    def __init__(self):
+        self._drone = compile_binary(DRONE_FIELDS)
+        self._buffer = bytearray()
+
+    def dumps(self, path, args):
+        """Encode a message.
+
+        Parameters:
+          - path: URL of the target page, telling the schema of the message
+          - args: JSON-ready content of the message
+
+        Return the encoded message as bytes.
+        """
+        buffer = self._buffer
+        del buffer[:]
+        key = DRONES_KEYS.get(path)
+        if key is None or not isinstance(args, dict) or key not in args:
+            _pack(args, buffer)
+            return bytes(buffer)
+        buffer += _header('map', len(args))
+        _pack(key, buffer)
+        drones = args[key]
+        buffer += _header('array', len(drones))
+        for drone in drones:
+            try:
+                buffer += self._drone(drone)
+            except (KeyError, TypeError):
+                _pack(drone, buffer)
+        for name, value in args.items():
+            if name != key:
+                _pack(name, buffer)
+                _pack(value, buffer)
+        return bytes(buffer)
+
+    def loads(self, body):
+        """Decode a message encoded by `dumps`."""
+        return unpack(body)
+
+
+_FIXED = {0xc0: None, 0xc2: False, 0xc3: True}
+_NUMBERS = {
+    0xca: struct.Struct('>f'), 0xcb: struct.Struct('>d'),
+    0xcc: struct.Struct('>B'), 0xcd: struct.Struct('>H'),
+    0xce: struct.Struct('>I'), 0xcf: struct.Struct('>Q'),
+    0xd0: struct.Struct('>b'), 0xd1: struct.Struct('>h'),
+    0xd2: struct.Struct('>i'), 0xd3: struct.Struct('>q'),
+}
+_SIZES = {
+    0xd9: ('str', struct.Struct('>B')), 0xda: ('str', struct.Struct('>H')),
+    0xdb: ('str', struct.Struct('>I')),
+    0xdc: ('array', struct.Struct('>H')), 0xdd: ('array', struct.Struct('>I')),
+    0xde: ('map', struct.Struct('>H')), 0xdf: ('map', struct.Struct('>I')),
+}
+
+
+def _unpack(data, offset):
+    """Decode the value starting at the given offset.
+
+    Return the value and the offset of the next one.
+    """
+    byte = data[offset]
+    offset += 1
+    if byte < 0x80:
+        return byte, offset
+    if byte >= 0xe0:
+        return byte - 0x100, offset
+    if byte in _FIXED:
+        return _FIXED[byte], offset
+    if byte in _NUMBERS:
+        layout = _NUMBERS[byte]
+        value, = layout.unpack_from(data, offset)
+        return value, offset + layout.size
+    if byte <= 0x8f:
+        kind, size = 'map', byte & 0x0f
+    elif byte <= 0x9f:
+        kind, size = 'array', byte & 0x0f
+    elif byte <= 0xbf:
+        kind, size = 'str', byte & 0x1f
+    elif byte in _SIZES:
+        kind, layout = _SIZES[byte]
+        size, = layout.unpack_from(data, offset)
+        offset += layout.size
+    else:
+        raise SerializerError(_('Unsupported type: {:#x}').format(byte))
+    if kind == 'str':
+        end = offset + size
+        if end > len(data):
+            raise SerializerError(_('Truncated message'))
+        return bytes(data[offset:end]).decode('utf-8'), end
+    if kind == 'array':
+        items = []
+        for index in range(size):
+            item, offset = _unpack(data, offset)
+            items.append(item)
+        return items, offset
+    mapping = {}
+    for index in range(size):
+        key, offset = _unpack(data, offset)
+        mapping[key], offset = _unpack(data, offset)
+    return mapping, offset
+
+
+def unpack(body):
+    """Decode a message encoded by the binary serializer."""
+    try:
+        value, end = _unpack(body, 0)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise SerializerError(*e.args)
+    if end != len(body):
+        raise SerializerError(_('Trailing data after message'))
+    return value
+
+
+def loads(body):
+    """Decode a message encoded by either serializer: binary messages are
+    bytes, JSON ones are strings.
+    """
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return unpack(body)
+    return json.loads(body)
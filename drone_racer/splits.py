@@ -0,0 +1,112 @@
+"""Columnar storage of the passages of drones through timing gates.
+
+Every passage through a timing gate is written into arrays allocated
+once when the race is setup, one column per drone and gate, so that
+recording an event does not build any Python object. Columns are used
+as circular buffers: only the last passages are kept for each drone
+and gate while counters and best sector times account for the whole
+race. The memory used by the splits is thus bounded; rankings and judge
+edits still rely on the full history of passages kept by the rules.
+
+Sector times are the ones measured by the gates: time added by the
+judges is not accounted for.
+
+A sector is the portion of the route flown by a drone between two
+consecutive timing gates and is named after the gate ending it.
+"""
+
+
+from array import array
+
+
+NO_TIME = float('inf')
+
+
+class Splits:
+    """Passages of the drones attending a race through timing gates."""
+
+    def __init__(self, drones, gates, resolution=1000, capacity=64):
+        """Allocate the columns for a race.
+
+        Parameters:
+          - drones: amount of drone numbers used by the race
+          - gates: identification letter(s) of the timing gates
+          - resolution: amount of ticks per second of the race clock,
+            sector times are rounded to it
+          - capacity: amount of passages kept for each drone and gate
+        """
+        self.resolution = resolution
+        self.capacity = capacity
+        self.gates = {gate: index for index, gate in enumerate(gates)}
+        size = drones * len(self.gates)
+        self.columns = [array('d', [0.0]) * capacity for _ in range(size)]
+        self.counts = array('i', [0]) * size
+        self.bests = array('d', [NO_TIME]) * size
+        self.last_times = array('d', [0.0]) * drones
+        self.last_gates = array('i', [-1]) * drones
+
+    def _column(self, drone, gate):
+        """Return the index of the column of a drone for a gate."""
+        return drone * len(self.gates) + self.gates[gate]
+
+    def record(self, drone, gate, time):
+        """Store the passage of a drone through a gate.
+
+        Parameters:
+          - drone: the 0-based identification number of the drone
+          - gate: identification letter(s) of the gate reached
+          - time: time of the drone when it reached the gate
+
+        Return the time of the sector just cleared or None if it is the
+        first timing gate reached by the drone.
+        """
+        try:
+            column = self._column(drone, gate)
+        except KeyError:
+            return None
+        count = self.counts[column]
+        self.columns[column][count % self.capacity] = time
+        self.counts[column] = count + 1
+        sector = None
+        if self.last_gates[drone] >= 0:
+            sector = time - self.last_times[drone]
+            sector = round(sector * self.resolution) / self.resolution
+            if sector < self.bests[column]:
+                self.bests[column] = sector
+        self.last_times[drone] = time
+        self.last_gates[drone] = self.gates[gate]
+        return sector
+
+    def passages(self, drone, gate):
+        """Return the times, in chronological order, of the last passages
+        of a drone through a gate that are still stored.
+
+        Parameters:
+          - drone: the 0-based identification number of the drone
+          - gate: identification letter(s) of the gate
+        """
+        column = self._column(drone, gate)
+        count = self.counts[column]
+        times = self.columns[column]
+        if count <= self.capacity:
+            return times[:count]
+        start = count % self.capacity
+        return times[start:] + times[:start]
+
+    def count(self, drone, gate):
+        """Return the amount of passages of a drone through a gate."""
+        return self.counts[self._column(drone, gate)]
+
+    def best_sector(self, drone, gate):
+        """Return the best time of a drone on the sector ending at a gate,
+        or None if the drone did not clear it yet.
+        """
+        best = self.bests[self._column(drone, gate)]
+        return None if best == NO_TIME else best
+
+    def best_sectors(self, drone):
+        """Return the best times of a drone for each sector it cleared,
+        indexed by the gate ending the sector.
+        """
+        bests = {gate: self.best_sector(drone, gate) for gate in self.gates}
+        return {gate: best for gate, best in bests.items() if best is not None}
@@ -1,5 +1,6 @@
 import os.path
 import sqlite3
+from itertools import count
 from string import ascii_uppercase as LETTERS
 from .i18n import translations
 
@@ -20,6 +21,10 @@ class Database:
     Provide access to underlying data through methods rather than SQL queries.
     """
 
+    # Revisions are unique across every database opened so that objects
+    # compiled from a route can not be mistaken for those of another one
+    _revisions = count()
+
     def __init__(self, filename):
         """Open a database and quickly check its integrity."""
         try:
@@ -118,6 +123,8 @@ class Database:
 
         self.conn = c
         self.event = None
+        # Identifier and revision of the routes looked up so far
+        self._games = {}
 
     def _execute(self, query, *args):
         """Convenient wrapper to auto-commit changes.
@@ -275,6 +282,8 @@ class Database:
         # Gate id, type, points, next
         for g,t,p,n in gates:
             self._execute(query, game_id, g, t, p, n)
+        # Objects compiled from the previous settings are now outdated
+        self._games[(self.event, name)] = (game_id, next(self._revisions))
         return created
 
     def register_new_race(self, game_name, contestants):
@@ -303,6 +312,17 @@ class Database:
             self._execute(query, race_id, driver_id, drone_id, beacon)
         return race_id
 
+    def delete_race(self, race_id):
+        """Remove a race that could not be setup along with its contestants.
+
+        Parameter:
+          - race_id: the identification number of the race to remove
+        """
+        query = 'DELETE FROM coureurs WHERE course_id=?'
+        self._execute(query, race_id)
+        query = 'DELETE FROM courses WHERE id=?'
+        self._execute(query, race_id)
+
     def get_drivers(self):
         """Fetch the name of all registered contestants."""
         query = 'SELECT nom FROM pilotes'
@@ -379,6 +399,30 @@ class Database:
         event, = self._execute(query, event_id).fetchone()
         return name, event
 
+    def get_game_revision(self, game_name):
+        """Return a 2-items-tuple identifying the current settings of a
+        route of the event bound to this object:
+          - the identifier of the route in the database
+          - a revision number changing each time the route is registered
+
+        The database is only queried the first time a route is looked up.
+
+        Parameter:
+          - game_name: the name of the route to identify
+        """
+        if self.event is None:
+            raise SQLError(_('No event loaded; '
+                             'can not retrieve associated games.'))
+        key = (self.event, game_name)
+        try:
+            return self._games[key]
+        except KeyError:
+            pass
+        query = 'SELECT id FROM jeux WHERE event_id=? and intitule=?'
+        game_id, = self._execute(query, self.event, game_name).fetchone()
+        revision = self._games[key] = (game_id, next(self._revisions))
+        return revision
+
     def get_game_settings(self, game_name):
         """Fetch a specific route and set of rules from the event bound to
         this object.
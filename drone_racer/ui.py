@@ -1,10 +1,17 @@
 from gi.repository import Gtk, GLib, Gio, Gdk, Pango, GdkPixbuf
 from threading import Timer
-from datetime import datetime, timedelta
+from datetime import timedelta
+from functools import partial
 
 from .threads import StdInReader
-from .console import Console, ConsoleError, Rules, FreeForAll, Gates
+from .clock import RaceClock
+from .console import Console, ConsoleError, RaceRegistry, RulesCache
+from .console import Rules, FreeForAll, Gates
 from .sql import Database, SQLError
+from .journal import Journal, JournalError
+from .outbox import OutboxError
+from .publishers import RESTPublisher, MulticastPublisher, PublisherGroup
+from .publishers import SpectatorPublisher
 from . import rest
 
 try:
@@ -135,7 +142,8 @@ class DroneRacer(Gtk.Application):
     this window.
     """
 
-    def __init__(self, reader, fancy=False):
+    def __init__(self, reader, fancy=False, resolution=1000, multicast=None,
+                 spectators=None, tracks=None):
         """Initialize the application life-cycle and connect management
         functions to its main events.
 
@@ -144,12 +152,22 @@ class DroneRacer(Gtk.Application):
             events from the gates
           - fancy: whether the main window should use a fancy header bar or
             the regular title bar
+          - resolution: amount of ticks per second of the race clock
+          - multicast: (group, port) tuple of the multicast group races
+            are broadcast to on the LAN, if any
+          - spectators: port of the spectator server to run within the
+            application, if any
+          - tracks: list of (name, beacons) couples describing the tracks
+            races can run on in parallel, beacons being the range of
+            beacon numbers allowed on the track or None; a single unnamed
+            track is used by default
         """
         Gtk.Application.__init__(self)
         self.set_application_id('org.race.drone')
         self.set_flags(0)
         # Save window parameters for later use
-        self.window_setup = (reader, fancy)
+        self.window_setup = (
+                reader, fancy, resolution, multicast, spectators, tracks)
 
         self.connect('startup', self._on_startup)
         self.connect('activate', self._on_activate)
@@ -183,7 +201,8 @@ class DroneRacer(Gtk.Application):
         self._connect_action('win_open_dialog', self.window.open_database)
         self._connect_action('win_close', self.window.close_database)
         self._connect_action('quit', self.close_application)
-        self._connect_action('rest', self._manage_rest_server)
+        if self.window.use_rest:
+            self._connect_action('rest', self._manage_rest_server)
         self._connect_action('version', self._create_info, 'Version',
                 'Version : 1.1.0',
                 'Date de création : 6 mai 2015',
@@ -313,8 +332,8 @@ class DroneRacer(Gtk.Application):
                 self.window.import_drivers(filename)
 
     def _manage_rest_server(self, action, user_data):
-        """Create a dialog window to specifically manage the URL to the
-        web server hosting the REST API.
+        """Create a dialog window to specifically manage the URLs to the
+        web servers hosting the REST API.
         """
         # Create the dialog, populate and show it
         dialog = Gtk.Dialog('REST server', self.window, Gtk.DialogFlags.MODAL)
@@ -328,16 +347,25 @@ class DroneRacer(Gtk.Application):
         box = Gtk.VBox()
         box.set_margin_bottom(10)
         dialog.get_content_area().add(box)
-        box.pack_start(Gtk.Label('Adresse web de l’API REST'), True, True, 1)
+        box.pack_start(Gtk.Label(
+            'Adresses web des API REST (séparées par des espaces)'),
+            True, True, 1)
         entry = Gtk.Entry()
-        entry.set_text(rest._REST_ADDR)
+        endpoints = rest.endpoints()
+        entry.set_text(' '.join(p.address for p in endpoints))
         box.pack_start(entry, False, False, 1)
+        for publisher in endpoints:
+            if not publisher.healthy:
+                label = Gtk.Label('{} injoignable : {}'.format(
+                    publisher.address, publisher.last_error))
+                label.set_line_wrap(True)
+                box.pack_start(label, False, False, 1)
         dialog.show_all()
         # Wait for user interaction
         response = dialog.run()
-        # Update the REST server URL if need be
+        # Update the REST servers URLs if need be
         if response == Gtk.ResponseType.OK:
-            rest._REST_ADDR = entry.get_text()
+            rest.set_endpoints(entry.get_text().split())
         dialog.destroy()
 
     def close_application(self, action, user_data):
@@ -351,7 +379,8 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
     informations, do all the things.
     """
 
-    def __init__(self, application, reader, fancy):
+    def __init__(self, application, reader, fancy, resolution, multicast,
+                 spectators, tracks):
         """Instantiate and populate the window.
 
         Parameters:
@@ -360,10 +389,35 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
             events from the gates
           - fancy: whether this window should use a fancy header bar or
             the regular title bar
+          - resolution: amount of ticks per second of the race clock
+          - multicast: (group, port) tuple of the multicast group races
+            are broadcast to on the LAN, if any
+          - spectators: port of the spectator server to run within the
+            application, if any
+          - tracks: list of (name, beacons) couples describing the tracks
+            races can run on in parallel, or None for a single track
         """
         # Non-Gtk attributes
-        self.console = Console(self.get_time, self.update_race)
-        self.reader_thread = reader(self.console.compute_data)
+        self.clock = RaceClock(resolution)
+        # Spectators are served from within the application instead of
+        # through the REST API when a port is given
+        self.use_rest = spectators is None
+        if self.use_rest:
+            self.publisher = PublisherGroup(RESTPublisher())
+        else:
+            self.publisher = PublisherGroup(SpectatorPublisher(spectators))
+        if multicast is not None:
+            self.publisher.add(MulticastPublisher(*multicast))
+        self.races = RaceRegistry()
+        for track, beacons in tracks or [(None, None)]:
+            self.races.add_track(Console(
+                    self.clock, partial(self.update_race, track=track),
+                    track, beacons, publisher=self.publisher))
+        # Console of the track monitored in the window
+        self.console = next(iter(self.races))
+        self.race_ids = {}
+        self.routes = RulesCache()
+        self.reader_thread = reader(self.races.compute_data)
         self.db = None
         self.beacon_names = None
 
@@ -408,18 +462,21 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
         self.race_dropdown = Gtk.ComboBoxText()
         self.race_dropdown.connect('changed', self._on_race_change)
         self.race_box = Gtk.VBox(spacing=6)
+        self.track_dropdown = Gtk.ComboBoxText()
+        for console in self.races:
+            self.track_dropdown.append_text(console.track or '')
+        self.track_dropdown.connect('changed', self._on_track_change)
         
         # Widgets that are updated during a race (beware of multi-threading)
         self.label_warmup = Gtk.Label()
         self.label_font = self.label_warmup.get_pango_context(
                 ).get_font_description()
         self.update_box = Gtk.ListStore(
-                int, str, str, int, int, int, str, str, str, str, str, str)
+                int, str, str, int, int, int, str, str, str, str, str, str,
+                str)
         self.button_box = Gtk.HBox()
         self.countdown = None
-        self.timer_start = datetime.now()
         self.timer_elapsed = timedelta(0, 0, 0)
-        self.race_id = None
 
         # Populate content
         self.main = Gtk.Stack()
@@ -456,6 +513,15 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
         # Show default screen and provide a custom (sub)title
         self.activate_default()
 
+    @property
+    def race_id(self):
+        """Identification of the race monitored on the selected track."""
+        return self.race_ids.get(self.console.track)
+
+    @race_id.setter
+    def race_id(self, race_id):
+        self.race_ids[self.console.track] = race_id
+
     ###                                 ###
     #                                     #
     # Building and activating UI elements #
@@ -516,6 +582,10 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
                 self.event_dropdown.get_child().set_text('')
                 self.activate_loaded()
                 self._load_dropdown_values()
+                for console in self.races:
+                    if console.recover():
+                        self.console = console
+                        self._resume_race()
         row = Gtk.HBox()
         buttons_setup = (
             ('Ouvrir', 'document-open', check_entries),
@@ -796,6 +866,12 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
     def create_race_manager(self):
         panel = Gtk.VBox(spacing=6)
         row = Gtk.HBox()
+        row.pack_start(Gtk.Label('Piste'), False, False, 4)
+        row.pack_start(self.track_dropdown, True, True, 4)
+        panel.pack_start(row, True, False, 4)
+        # No need to choose when races run on a single track
+        row.set_no_show_all(len(self.track_dropdown.get_model()) < 2)
+        row = Gtk.HBox()
         row.pack_start(Gtk.Label('Type de jeu'), False, False, 4)
         row.pack_start(self.race_dropdown, True, True, 4)
         panel.pack_start(row, True, False, 4)
@@ -804,6 +880,13 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
             self.race_dropdown.set_active(-1)
             self.activate_loaded()
         def check_entries(widget):
+            if self.track_dropdown.get_active() < 0:
+                dialog = WaitDialog(self,
+                        'Erreur à la création d’une course',
+                        'La piste n’est pas définie')
+                dialog.run()
+                dialog.destroy()
+                return
             if self.race_dropdown.get_active() < 0:
                 dialog = WaitDialog(self,
                         'Erreur à la création d’une course',
@@ -814,7 +897,9 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
             entrants = []
             drivers = set()
             drones = set()
-            beacon = 0
+            # Beacons are handed out from the first one of the track
+            beacons = self.console.beacons
+            beacon = beacons[0] - 1 if beacons else 0
             for row in self.race_box.get_children():
                 beacon += 1
                 _, driver, _, drone, _ = row.get_children()
@@ -841,25 +926,32 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
                 drivers.add(driver)
                 drones.add(beacon)
             if entrants:
+                game_name = self.race_dropdown.get_active_text()
+                track = self.console.track
+                race_id = None
                 try:
-                    game_name = self.race_dropdown.get_active_text()
-                    _, race_time, race_laps, free_fly, strict, beacons =\
-                            self.db.get_game_settings(game_name)
-                    rules_type = FreeForAll if free_fly else Rules
-                    rules = rules_type(race_time, strict, race_laps, beacons)
+                    # Routes are checked when compiled into rules
+                    rules = self.routes.get(
+                            self.db.get_game_revision(game_name),
+                            lambda: self._compile_rules(game_name))
+                    race_id = self.db.register_new_race(game_name, entrants)
+                    self.races.setup_race(track, drones, rules, race_id)
                 except ConsoleError as e:
+                    # Do not leave a race that never happened in the stats
+                    if race_id is not None:
+                        self.db.delete_race(race_id)
                     dialog = WaitDialog(self,
                             'Erreur à la création d’une course',
                             e.args[0])
                     dialog.run()
                     dialog.destroy()
                 else:
-                    race_id = self.db.register_new_race(game_name, entrants)
-                    self.console.setup_race(drones, rules)
                     self.race_dropdown.set_active(-1)
                     self.activate_launch_race(race_id)
                     ordered_drivers = self.db.get_race_drivers(race_id)
-                    rest.setup(game_name, rules, *ordered_drivers)
+                    self.publisher.setup(
+                            game_name, rules, *ordered_drivers,
+                            track=track, race=race_id)
             else:
                 dialog = WaitDialog(self,
                         'Erreur à la création d’une course',
@@ -879,13 +971,29 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
         panel.pack_end(row, True, False, 4)
         return panel
 
+    def _compile_rules(self, game_name):
+        """Build the Rules object of a route from its settings stored in
+        the database.
+        """
+        _, race_time, race_laps, free_fly, strict, beacons =\
+                self.db.get_game_settings(game_name)
+        rules_type = FreeForAll if free_fly else Rules
+        return rules_type(race_time, strict, race_laps, beacons)
+
     def activate_race_manager(self, *widget):
         """If no race is started, show the panel used to setup a new race.
         Show the race status otherwise.
+
+        When races run on several tracks, the setup panel is always shown
+        so that the track can be chosen first; choosing a track with a
+        race in progress shows the status of that race instead.
         """
-        if self.race_id is not None:
+        several = len(self.track_dropdown.get_model()) > 1
+        if self.countdown is not None or (
+                self.race_id is not None and not several):
             self.activate_launch_race()
         else:
+            self.track_dropdown.set_active(0 if not several else -1)
             self.set_custom_title('Mise en place d’une course')
             self.main.set_visible_child_name('race')
 
@@ -926,11 +1034,17 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
         column.set_alignment(0.5)
         treeview.append_column(column)
         renderer.connect('edited', self._on_judge_edition)
+        index += 1
+        renderer = Gtk.CellRendererText(xalign=0.5)
+        column = Gtk.TreeViewColumn('Meilleurs secteurs', renderer, text=index)
+        column.set_alignment(0.5)
+        treeview.append_column(column)
         panel.pack_start(treeview, True, True, 4)
         def cancel_race(widget):
             drones = len(self.console.scores)
             self.console.cancel_race()
-            self.db.update_race(self.race_id, *self.console.scores)
+            self.db.update_race(
+                    self.race_id, *self.console.snapshot.leaderboard)
             self.button_box.get_children()[3].set_sensitive(True)
             self.race_id = None
             self.label_warmup.modify_font(self.label_font)
@@ -939,7 +1053,9 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
             self.label_warmup.modify_font(self.label_font)
             leaderboard = self.console.compute_leaderboard()
             self.db.update_race(self.race_id, *leaderboard)
-            rest.leaderboard(*leaderboard)
+            self.console.close_race()
+            self.publisher.leaderboard(
+                    *leaderboard, track=self.console.track)
             self.race_id = None
             self.activate_loaded()
         def stop_race(widget):
@@ -989,7 +1105,7 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
             for driver in self.db.get_race_drivers(race_id):
                 self.update_box.append([
                     driver['id'], driver['nom'], driver['drone'], 1, 0,
-                    0, '00:00.0', '00:00.0', '-', '-', '\uf018', ''])
+                    0, '00:00.0', '00:00.0', '-', '-', '\uf018', '', ''])
             self.button_box.show_all()
             # Hide both 'stop' and 'close' buttons
             self.button_box.get_children()[2].hide()
@@ -1356,6 +1472,27 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
             self.event_dropdown.remove_all()
             for event in self.db.get_events():
                 self.event_dropdown.append_text(event)
+            # Keep track of every event of the races to survive a crash
+            for console in self.races:
+                journal = filename + '.journal'
+                if console.track is not None:
+                    journal = '{}.{}.journal'.format(filename, console.track)
+                try:
+                    console.journal = Journal(journal)
+                except JournalError as e:
+                    dialog = WaitDialog(self,
+                            'Journal des courses inaccessible', e.args[0])
+                    dialog.run()
+                    dialog.destroy()
+            # Messages for the spectators are kept until they are delivered
+            try:
+                if self.use_rest:
+                    rest.use_outbox(filename + '.outbox')
+            except OutboxError as e:
+                dialog = WaitDialog(self,
+                        'Messages pour le public non conservés', e.args[0])
+                dialog.run()
+                dialog.destroy()
             # Redirect to the event selection screen on success
             self.activate_event()
 
@@ -1363,10 +1500,15 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
         """Close any currently open database and revert the window to
         its original state.
         """
-        try:
-            self.console.stop_race()
-        except ConsoleError:
-            pass
+        for console in self.races:
+            try:
+                console.stop_race()
+            except ConsoleError:
+                pass
+            if console.journal:
+                console.journal.close()
+                console.journal = None
+        self.race_ids.clear()
         self._clear_dropdown_values()
         if self.db:
             self.db.close()
@@ -1579,6 +1721,13 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
             panel.pack_start(row, True, False, 4)
             panel.show_all()
 
+    def _on_track_change(self, widget):
+        if widget.get_active() > -1:
+            self.console = list(self.races)[widget.get_active()]
+            # Monitor the race of this track if there is one
+            if self.race_id is not None:
+                self._resume_race()
+
     def _on_race_change(self, widget):
         self.race_box.foreach(lambda w: w.destroy())
         if widget.get_active() > -1:
@@ -1653,14 +1802,13 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
         self.countdown -= 1
         c = self.countdown
         text = str(c) if c else 'GO!'
-        rest.warmup(text, c == -1)
+        self.publisher.warmup(text, c == -1, self.console.track)
         if c >= 0:
             self.label_warmup.set_text(text)
             return True
         cancel_btn, stop_btn = self.button_box.get_children()[1:4:2]
         try:
             self.timer_elapsed = timedelta(0, 0, 0)
-            self.timer_start = datetime.now()
             self.console.start_race()
         except ConsoleError as e:
             dialog = WaitDialog(self, 'Une erreur est survenue', e.args[0])
@@ -1668,14 +1816,46 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
             dialog.destroy()
         else:
             stop_btn.set_sensitive(True)
-            GLib.idle_add(self._show_timer)
+            GLib.idle_add(self._show_timer, self.console)
         finally:
             cancel_btn.set_sensitive(True)
             self.countdown = None
         return False
 
-    def _show_timer(self):
-        elapsed = datetime.now() - self.timer_start
+    def _resume_race(self):
+        """Show the status of the race of the selected track and resume
+        its monitoring. The race was either recovered from the journal
+        after a crash of the application or left running while another
+        track was monitored.
+        """
+        self.activate_launch_race(self.console.race)
+        self.label_warmup.modify_font(self.label_font)
+        leaderboard = self.console.snapshot.leaderboard
+        self._grid_update(
+                {status['id']: status for status in leaderboard},
+                self.console.track,
+                {status['id']: self.console.best_sectors(status['id'])
+                 for status in leaderboard})
+        cnl_btn, close_btn, stop_btn, start_btn =\
+                self.button_box.get_children()[1:5]
+        if self.console.snapshot.running:
+            start_btn.hide()
+            stop_btn.show_all()
+            self.label_warmup.modify_font(Pango.FontDescription('40'))
+            self.timer_elapsed = timedelta(0, int(self.console.elapsed()))
+            GLib.idle_add(self._show_timer, self.console)
+        elif self.console.rules is None:
+            # Over but not closed yet
+            cnl_btn.hide()
+            start_btn.hide()
+            close_btn.show_all()
+            self.label_warmup.set_text('Course terminée')
+
+    def _show_timer(self, console):
+        # Monitoring of another track: restarted when coming back here
+        if console is not self.console:
+            return False
+        elapsed = timedelta(0, self.console.elapsed())
         interval = timedelta(0, 0, 100000)
         if elapsed < self.timer_elapsed + interval:
             return True
@@ -1683,38 +1863,44 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
         mins, secs = divmod(self.timer_elapsed.seconds, 60)
         self.label_warmup.set_text('{:02d}:{:02d}.{}'.format(mins, secs,
             self.timer_elapsed.microseconds//100000))
-        if not self.console.extra_data:
+        running = self.console.snapshot.running
+        if not running:
             cnl_btn, close_btn, stop_btn = self.button_box.get_children()[1:4]
             cnl_btn.hide()
             stop_btn.hide()
             close_btn.show_all()
-        return bool(self.console.extra_data)
-
-    def get_time(self):
-        time = datetime.now() - self.timer_start
-        return time.seconds * 10 + time.microseconds // 100000
-
-    def update_race(self, status):
-        GLib.idle_add(
-                self._grid_update, status['id'],
-                status['position'], status['points'],
-                status['tours'], status['temps'],
-                status['retard'], status['tour'],
-                status['porte'], status['finish'])
-
-    def _grid_update(self, i, pos, pts, laps, time, delay, last, beacon, end):
+        return running
+
+    def update_race(self, statuses, track=None):
+        console = self.races[track]
+        GLib.idle_add(self._grid_update,
+                {status['id']: status for status in statuses}, track,
+                {status['id']: console.best_sectors(status['id'])
+                 for status in statuses})
+
+    def _grid_update(self, statuses, track=None, sectors=None):
+        # Races of other tracks keep going without being displayed
+        if track != self.console.track:
+            return
         for row in self.update_box:
-            if row[0] != i:
+            status = statuses.get(row[0])
+            if status is None:
                 continue
-            row[3] = pos
-            row[4] = pts
-            row[5] = laps
-            row[6] = '{:02.0f}:{:04.1f}'.format(*divmod(time, 60))
-            row[7] = '{:02.0f}:{:04.1f}'.format(*divmod(delay, 60))
-            if last:
-                row[8] = '{:02.0f}:{:04.1f}'.format(*divmod(last, 60))
-            if beacon:
-                row[9] = beacon
+            if sectors and sectors.get(row[0]):
+                row[12] = ' '.join(
+                        '{} {:02.0f}:{:04.1f}'.format(gate, *divmod(best, 60))
+                        for gate, best in sorted(sectors[row[0]].items()))
+            row[3] = status['position']
+            row[4] = status['points']
+            row[5] = status['tours']
+            row[6] = '{:02.0f}:{:04.1f}'.format(*divmod(status['temps'], 60))
+            row[7] = '{:02.0f}:{:04.1f}'.format(*divmod(status['retard'], 60))
+            if status['tour']:
+                row[8] = '{:02.0f}:{:04.1f}'.format(
+                        *divmod(status['tour'], 60))
+            if status['porte']:
+                row[9] = status['porte']
+            end = status['finish']
             row[10] = '\uf1d9' if end is None else end and '\uf11e' or '\uf0f9'
 
     ###                              ###
@@ -1723,12 +1909,17 @@ class DroneRacerWindow(Gtk.ApplicationWindow):
     #                                  #
     ###                              ###
     def shutdown(self, *args):
-        try:
-            self.console.stop_race()
-        except ConsoleError:
-            pass
+        for console in self.races:
+            try:
+                console.stop_race()
+            except ConsoleError:
+                pass
+            self.publisher.cancel(console.track)
+            if console.journal:
+                console.journal.close()
         if self.db:
             self.db.close()
-        rest.cancel()
         self.reader_thread.stop()
+        # Let the spectators know about the canceled races
+        self.publisher.shutdown()
         print('Drone Racer successfully shut down')
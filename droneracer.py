@@ -35,6 +35,21 @@ parser = ArgumentParser(description=_('"Drone Racer"\'s Graphical User Interface
 parser.add_argument(
         '--fancy-title', dest='fancy', action='store_true',
         help=_('Use a fancier (Gtk3 like) titlebar for the GUI'))
+parser.add_argument(
+        '--clock-resolution', dest='resolution', metavar='TICKS', type=int,
+        default=1000, help=_('Amount of ticks per second used to time races'))
+parser.add_argument(
+        '--multicast', dest='multicast', metavar='GROUP[:PORT]', default=None,
+        help=_('Broadcast races as UDP datagrams to this multicast group'))
+parser.add_argument(
+        '--spectators-port', dest='spectators', metavar='NUM', type=int,
+        default=None, help=_('Serve spectators from within the application '
+        'on this port instead of through the REST API'))
+parser.add_argument(
+        '--track', dest='tracks', metavar='NAME[:FIRST-LAST]',
+        action='append', default=None, help=_('Run races in parallel on '
+        'this track, optionally restricted to a range of beacons; repeat '
+        'the option for each track'))
 subparsers = parser.add_subparsers(
         title='communication', dest='reader', description=_('List off all '
         'communication channels to get data from the gates. If none is '
@@ -71,9 +86,32 @@ elif args.reader in UDP_NAMES:
 else:
     reader = drone_racer.StdInReader()
 
+multicast = None
+if args.multicast:
+    group, separator, port = args.multicast.partition(':')
+    multicast = group, int(port or 4388)
+
+tracks = None
+if args.tracks:
+    tracks = []
+    for track in args.tracks:
+        name, separator, beacons = track.partition(':')
+        if not name or name in (known for known, _range in tracks):
+            parser.error(_('Track names must be unique and non empty'))
+        if beacons:
+            first, separator, last = beacons.partition('-')
+            try:
+                beacons = range(int(first), int(last or first) + 1)
+            except ValueError:
+                parser.error(_('Invalid range of beacons for track {}').format(
+                        name))
+        tracks.append((name, beacons or None))
+
 # Be sure to be at the right place for relative path of images in Gtk
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 # Launch the GUI (which will, in turn, start the reader)
-app = drone_racer.Application(reader, args.fancy)
+app = drone_racer.Application(
+        reader, args.fancy, args.resolution, multicast, args.spectators,
+        tracks)
 app.run()
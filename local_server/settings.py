@@ -1,4 +1,5 @@
 import os.path
+import tempfile
 
 
 class Settings:
@@ -6,4 +7,18 @@ class Settings:
     password = 'admin'
     debug = False
     port = 8000
+    # Use permessage-deflate with the browsers supporting it
+    compression = False
+    # Amount of messages kept to bring reconnecting spectators up to date
+    history = 256
+    # Amount of messages queued for a slow spectator before replacing
+    # them by a snapshot of the race
+    backlog = 64
+    # Seconds without reading anything before a spectator is disconnected
+    lag = 30
+    # Amount of processes serving the spectators, 0 for one per CPU; with
+    # more than one, messages go through a hub listening on a Unix-domain
+    # socket (not available on Windows)
+    workers = 1
+    hub = os.path.join(tempfile.gettempdir(), 'drone_racer_spectators.sock')
     static = os.path.join(os.path.dirname(__file__), "static")
@@ -1,48 +1,109 @@
-var Application = function(aHost, aPort, aStatusID, aTitleID, aMessageID, aTableID) {
+var Application = function(aHost, aPort, aStatusID, aTitleID, aMessageID, aTableID, aChannels) {
   var app = this;
-  var socketManager,
+  var managers = {},
+      spareManager,
       socketOpenned = false,
+      everOpenned = false,
+      lastSeq = null,
+      retryDelay = 1000,
       socket;
 
+  app.updateStatus = function(message) {
+    var statusElem = $('#'+aStatusID);
+    statusElem.html(message);
+    statusElem.parent().show();
+  };
+
+  app.managerFor = function(channel) {
+    // Each track gets its own leader-board, the one of the page being
+    // used by the first track heard of
+    var key = (channel === undefined) ? null : channel;
+    if (!managers.hasOwnProperty(key)) {
+      if (spareManager) {
+        managers[key] = spareManager;
+        spareManager = null;
+      } else {
+        var section = $('#'+aTableID).closest('section');
+        var copy = section.clone();
+        copy.find('[id]').removeAttr('id');
+        copy.insertAfter(section.parent().children('section').last());
+        managers[key] = new WebSocketManager(
+            $('#'+aStatusID),
+            copy.find('h1'),
+            copy.find('p'),
+            copy.find('table')
+        );
+      }
+    }
+    return managers[key];
+  };
+
+  app.connect = function() {
+    var url = 'ws://'+aHost+':'+aPort+'/websocket/';
+    var params = [];
+    if (aChannels) {
+      // Only follow the races of some tracks
+      params.push('channels=' + encodeURIComponent(aChannels));
+    }
+    if (lastSeq !== null) {
+      // Only get the messages missed while disconnected
+      params.push('seq=' + lastSeq);
+    }
+    if (params.length) { url = url + '?' + params.join('&'); }
+    socket = new WebSocket(url);
+    socket.onopen = app.onSocketOpen;
+    socket.onclose = app.onSocketClose;
+    socket.onerror = app.onSocketError;
+    socket.onmessage = app.onSocketMessage;
+  };
+
   app.onSocketOpen = function(nil) {
     socketOpenned = true;
-    socketManager.updateStatus('Communication établie avec succès pour suivre les courses en direct.');
+    everOpenned = true;
+    retryDelay = 1000;
+    app.updateStatus('Communication établie avec succès pour suivre les courses en direct.');
   };
 
   app.onSocketClose = function(nil) {
-    if (socketOpenned) {
-      socketManager.updateStatus('Communication terminée. Le direct n’est plus accessible. Rafraîchissez la page pour relancer la connexion.');
+    if (everOpenned) {
+      app.updateStatus('Communication interrompue. Reconnexion au direct en cours…');
+      setTimeout(app.connect, retryDelay);
+      retryDelay = Math.min(retryDelay * 2, 30000);
     } else {
-      socketManager.updateStatus('Impossible de se connecter pour suivre le direct. Soit vous n’ouvrez pas la page depuis l’adresse '+aHost+', soit votre navigateur ne supporte pas websocket.');
+      app.updateStatus('Impossible de se connecter pour suivre le direct. Soit vous n’ouvrez pas la page depuis l’adresse '+aHost+', soit votre navigateur ne supporte pas websocket.');
     }
     socketOpenned = false;
   };
 
   app.onSocketError = function(error) {
-    socketManager.updateStatus('Une erreur est survenue : '+error.data);
+    app.updateStatus('Une erreur est survenue : '+error.data);
   };
 
   app.onSocketMessage = function(message) {
     try {
       var data=$.parseJSON(message.data);
-      socketManager.processMessage(data);
+      if (data.seq !== undefined) { lastSeq = data.seq; }
+      if (data.action === 'snapshot' && data.setup === null) {
+        // No race going on any of the tracks followed
+        $.each(managers, function(key, manager) {
+          manager.processMessage(data);
+        });
+      } else {
+        app.managerFor(data.piste).processMessage(data);
+      }
     } catch(e) {}
   };
 
   // Constructor
   (function() {
-    socketManager = new WebSocketManager(
+    spareManager = new WebSocketManager(
         $('#'+aStatusID),
         $('#'+aTitleID),
         $('#'+aMessageID),
         $('#'+aTableID)
     );
-    socket = new WebSocket('ws://'+aHost+':'+aPort+'/websocket/');
-    socket.onopen = app.onSocketOpen;
-    socket.onclose = app.onSocketClose;
-    socket.onerror = app.onSocketError;
-    socket.onmessage = app.onSocketMessage;
-    socketManager.updateStatus('Communication possible avec le serveur pour suivre les courses en direct. Attendez la fin de la phase de connexion.');
+    app.connect();
+    app.updateStatus('Communication possible avec le serveur pour suivre les courses en direct. Attendez la fin de la phase de connexion.');
   })();
 };
 
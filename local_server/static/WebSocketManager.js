@@ -53,7 +53,7 @@ var WebSocketManager = function(sElem, hElem, mElem, tElem) {
       service.state = 'setup';
       titleElem.html(data.course.nom);
       $.each(data.pilotes, function(idx, driver) {
-        var row = $('<tr id="Pilote'+driver.id+'">');
+        var row = $('<tr class="Pilote'+driver.id+'">');
         row.append($('<td>').append(driver.id));
         row.append($('<td>').append(driver.nom));
         row.append($('<td>').append(driver.drone));
@@ -69,6 +69,9 @@ var WebSocketManager = function(sElem, hElem, mElem, tElem) {
       });
       tableElem.show(1000);
       var msg = 'Portes activées sur ce circuit : ' + data.course.portes.join(' ');
+      if (data.piste) {
+        msg = 'Piste ' + data.piste + '<br /> ' + msg;
+      }
       if (data.course.temps !== null) {
         msg = msg + '<br /> Temps disponible : ' + service.getTime(data.course.temps/10);
       }
@@ -95,29 +98,43 @@ var WebSocketManager = function(sElem, hElem, mElem, tElem) {
   };
 
   this.updateHandler = function(data) {
+    // Only the cells of the fields provided are rewritten
     if (service.state !== 'canceled') {
-      var row = $('#Pilote'+data.id).find('td');
-      row.eq(3).html(data.position);
-      row.eq(4).html(data.points);
-      row.eq(5).html(service.getTime(data.temps));
-      row.eq(6).html(data.tours);
-      if (data.retard !== null) { row.eq(7).html(service.getTime(data.retard)); }
-      if (data.tour !== null) { row.eq(8).html(service.getTime(data.tour)); }
-      row.eq(9).html(data.porte || '-');
-      if (data.finish === null) {
-        row.eq(10).html('En vol');
-      } else {
-        row.eq(10).html(data.finish ? 'Arrivé' : 'Déclaré mort');
+      var row = tableElem.find('tr.Pilote'+data.id).find('td');
+      if ('position' in data) { row.eq(3).html(data.position); }
+      if ('points' in data) { row.eq(4).html(data.points); }
+      if ('temps' in data) { row.eq(5).html(service.getTime(data.temps)); }
+      if ('tours' in data) { row.eq(6).html(data.tours); }
+      if (data.retard != null) { row.eq(7).html(service.getTime(data.retard)); }
+      if (data.tour != null) { row.eq(8).html(service.getTime(data.tour)); }
+      if ('porte' in data) { row.eq(9).html(data.porte || '-'); }
+      if ('finish' in data) {
+        if (data.finish === null) {
+          row.eq(10).html('En vol');
+        } else {
+          row.eq(10).html(data.finish ? 'Arrivé' : 'Déclaré mort');
+        }
       }
     }
   };
 
+  this.updatesHandler = function(data) {
+    $.each(data.drones, function(idx, drone) {
+      service.updateHandler(drone);
+    });
+  };
+
+  this.deltasHandler = function(data) {
+    // Drones hold their id and the fields that changed only
+    service.updatesHandler(data);
+  };
+
   this.leaderboardHandler = function(data) {
     if (service.state === 'finished') {
-      service.state === 'canceled';
+      service.state = 'canceled';
       tableElem.find('th:eq(8)').html('Meilleur tour')
       $.each(data.drones, function(idx, drone) {
-        var row = $('#Pilote'+drone.id).find('td');
+        var row = tableElem.find('tr.Pilote'+drone.id).find('td');
         row.eq(3).html(drone.position);
         row.eq(4).html(drone.points);
         row.eq(5).html(service.getTime(drone.temps));
@@ -135,6 +152,23 @@ var WebSocketManager = function(sElem, hElem, mElem, tElem) {
     }
   };
 
+  this.snapshotHandler = function(data) {
+    service.cancelHandler(data);
+    if (data.setup === null) { return; }
+    service.setupHandler(data.setup);
+    if (data.warmup !== null) {
+      service.warmupHandler(data.warmup);
+      if (data.elapsed !== null) {
+        service.timer = Math.floor(data.elapsed * 10);
+      }
+    }
+    service.updatesHandler(data);
+    if (data.finish) { service.finishHandler(data); }
+    if (data.leaderboard !== null) {
+      service.leaderboardHandler({drones: data.leaderboard});
+    }
+  };
+
   this.processMessage = function(message) {
     var func = service[message.action+'Handler'];
     if (func) {
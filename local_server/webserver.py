@@ -1,12 +1,346 @@
-from base64 import decodestring as decode_64
+import json
+import zlib
+import socket
+import struct
+import asyncio
+import threading
+from itertools import chain
+from collections import deque
+from time import time, monotonic
+try:
+    from base64 import decodebytes as decode_64
+except ImportError:
+    from base64 import decodestring as decode_64
+
+from tornado import (
+        ioloop, web, websocket, httpserver, netutil, process, tcpserver)
+from tornado.iostream import IOStream, StreamClosedError
+try:
+    from .settings import Settings
+except ImportError:
+    # Run as a script from its own directory
+    from settings import Settings
+
+
+# Name of the channel standing for every channel in subscriptions
+ALL = '*'
+# Actions whose messages carry nothing but the channel they are about
+BARE_ACTIONS = frozenset(('cancel', 'finish'))
 
-from tornado import ioloop, web, websocket
-from settings import Settings
 
-
-last_race_setup = None
 server = None
+# Connection to the hub of the processes when serving with several ones
+hub = None
 liveWebSockets = set()
+# Spectators following each channel, by name of the channel; channels
+# are named after the track the races take place on
+subscribers = {ALL: set()}
+# State of the race of each channel
+race_states = {}
+# Compressors shared by every connection using permessage-deflate, by
+# size of their window
+compressors = {}
+# Identification and sequence number of the last message received for
+# the race of each track
+streams = {}
+# Last Message objects broadcast, so that spectators reconnecting after
+# a short drop only get what they missed
+history = deque(maxlen=Settings.history)
+# Sequence number of the last message broadcast; starting from the
+# current time keeps numbers growing across restarts of the server
+last_sequence = int(time() * 1000)
+
+
+def in_sequence(track, race, sequence):
+    """Tell whether a message is the most recent one received about a
+    race. Outdated and duplicated messages should be dropped.
+    """
+    if sequence is None:
+        # Message sent by a client that does not number them
+        return True
+    last_race, last_sequence = streams.get(track, (None, -1))
+    if race == last_race and sequence <= last_sequence:
+        return False
+    if race != last_race and None not in (race, last_race) and race < last_race:
+        return False
+    streams[track] = (race, sequence)
+    return True
+
+
+class Message:
+    """A message broadcast to the spectators, encoded once and framed at
+    most once per kind of connection.
+    """
+
+    def __init__(self, sequence, action, payload, encoded=None,
+                 channel=None):
+        """Parameters:
+          - sequence: number of the message
+          - action: kind of message
+          - payload: decoded object sent along the action
+          - encoded: UTF-8 encoded message; built from the payload if
+            not provided
+          - channel: name of the channel the message is broadcast on
+        """
+        self.sequence = sequence
+        self.action = action
+        self.payload = payload
+        self.channel = channel
+        if encoded is None:
+            encoded = json.dumps(
+                    dict(payload, action=action, seq=sequence),
+                    separators=(',', ':')).encode('utf-8')
+        self.encoded = encoded
+        self.frames = {}
+
+
+class Backlog:
+    """Messages waiting for a spectator that does not read them as fast
+    as they are broadcast.
+
+    Consecutive changes of drones of the same channel are conflated so
+    that each changed field of a drone is sent once. When too many other
+    messages pile up, they are all replaced by snapshots of the races.
+    """
+
+    def __init__(self):
+        self.since = monotonic()
+        self.messages = []
+        # Latest changes, by drone, if the last message is about drones
+        self.drones = None
+        self.conflated = 0
+        self.snapshot = False
+
+    def append(self, message):
+        """Queue a message, conflating it with the previous one if they
+        are both about changes of drones on the same channel.
+        """
+        if self.snapshot:
+            return
+        if (message.action == 'deltas' and self.drones is not None and
+                self.messages[-1].channel == message.channel):
+            # Keep the sequence number of the latest one
+            self.messages[-1] = message
+            self.conflated += 1
+        else:
+            self._seal()
+            self.messages.append(message)
+            if len(self.messages) > Settings.backlog:
+                self.messages = []
+                self.snapshot = True
+                return
+            if message.action != 'deltas':
+                return
+            self.drones = {}
+            self.conflated = 1
+        for drone in message.payload['drones']:
+            self.drones.setdefault(drone['id'], {}).update(drone)
+
+    def _seal(self):
+        """Replace the last message by the changes of drones it has been
+        conflated with, if any.
+        """
+        if self.drones is not None and self.conflated > 1:
+            last = self.messages[-1]
+            self.messages[-1] = Message(
+                    last.sequence, 'deltas',
+                    dict(last.payload, drones=list(self.drones.values())),
+                    channel=last.channel)
+        self.drones = None
+
+    def flush(self, ws):
+        """Write the queued messages to a spectator.
+
+        Return False if the connection is closed.
+        """
+        if self.snapshot:
+            return send_snapshots(ws, ws.channels, force=True)
+        self._seal()
+        for message in self.messages:
+            if not _write(ws, message.encoded, message.frames):
+                return False
+        return True
+
+
+class RaceState:
+    """Current state of the race, merged from every message broadcast,
+    so that spectators connecting in the middle of a race get the whole
+    picture at once instead of waiting for each drone to be updated.
+
+    The state is sent as a single 'snapshot' message, encoded and framed
+    once until a message is broadcast: a burst of reconnections only
+    costs a write per spectator.
+    """
+
+    # Seconds after which the elapsed time of a running race is refreshed
+    REFRESH = 1
+
+    def __init__(self, channel=None):
+        """Parameter:
+          - channel: name of the channel the race is broadcast on
+        """
+        self.channel = channel
+        self.reset()
+
+    def reset(self):
+        """Forget the current race."""
+        self.setup = None
+        self.warmup = None
+        self.started = None
+        self.drones = {}
+        self.finished = False
+        self.leaderboard = None
+        self._invalidate()
+
+    def _invalidate(self):
+        self._payload = None
+        self._frames = {}
+        self._built = None
+        self._sequence = None
+
+    def apply(self, action, payload):
+        """Update the state with a message just broadcast.
+
+        Parameters:
+          - action: kind of message
+          - payload: decoded object sent along the action
+        """
+        if action == 'setup':
+            self.reset()
+            self.setup = payload
+        elif action == 'cancel':
+            self.reset()
+        elif self.setup is None:
+            # Ignore messages about a race the server did not see the
+            # setup of; the snapshot still needs their sequence number
+            pass
+        elif action == 'warmup':
+            self.warmup = payload
+            if payload.get('start'):
+                self.started = monotonic()
+        elif action == 'update':
+            self.drones[payload['id']] = payload
+        elif action == 'updates':
+            for drone in payload['drones']:
+                self.drones[drone['id']] = drone
+        elif action == 'finish':
+            self.finished = True
+            self.started = None
+        elif action == 'leaderboard':
+            self.leaderboard = payload['drones']
+        self._invalidate()
+
+    def changes(self, drones):
+        """Return the fields of the statuses of some drones that differ
+        from their current status, along with their id. Drones that did
+        not change are left out.
+
+        Parameter:
+          - drones: latest status of each drone, about to be applied
+        """
+        changes = []
+        for drone in drones:
+            previous = self.drones.get(drone['id'], {})
+            changed = {key: value for key, value in drone.items()
+                       if key not in previous or previous[key] != value}
+            if changed:
+                changed['id'] = drone['id']
+                changes.append(changed)
+        return changes
+
+    def _encode(self):
+        """Return the snapshot message, UTF-8 encoded."""
+        now = monotonic()
+        # The snapshot is as recent as the last message of any channel
+        if self._payload is not None and self._sequence == last_sequence and (
+                self.started is None or now - self._built < self.REFRESH):
+            return self._payload
+        self._frames = {}
+        self._built = now
+        self._sequence = last_sequence
+        self._payload = json.dumps({
+            'action': 'snapshot',
+            'seq': last_sequence,
+            'piste': self.channel,
+            'setup': self.setup,
+            'warmup': self.warmup,
+            'elapsed': None if self.started is None else now - self.started,
+            'drones': list(self.drones.values()),
+            'finish': self.finished,
+            'leaderboard': self.leaderboard,
+        }, separators=(',', ':')).encode('utf-8')
+        return self._payload
+
+    def send(self, ws):
+        """Send the snapshot to a spectator.
+
+        Return False if the connection is closed.
+        """
+        return _write(ws, self._encode(), self._frames)
+
+
+def race_state(channel):
+    """Return the RaceState of a channel."""
+    state = race_states.get(channel)
+    if state is None:
+        state = race_states[channel] = RaceState(channel)
+    return state
+
+
+def send_snapshots(ws, channels, force=False):
+    """Send a spectator the snapshots of the races taking place on some
+    channels.
+
+    Parameters:
+      - ws: the WebSocketHandler to write to
+      - channels: names of the channels, ALL standing for every channel
+      - force: send an empty snapshot if there is no race, so that the
+        spectator forgets about the ones it knew
+
+    Return False if the connection is closed.
+    """
+    if ALL in channels:
+        states = list(race_states.values())
+    else:
+        states = [race_states[channel]
+                  for channel in channels if channel in race_states]
+    states = [state for state in states if state.setup is not None]
+    if force and not states:
+        states = [RaceState()]
+    return all(state.send(ws) for state in states)
+
+
+def subscribe(ws, channels):
+    """Make a spectator follow some channels. Following ALL replaces the
+    other subscriptions of the spectator, and the other way around.
+
+    Return the channels the spectator did not follow yet.
+    """
+    if ALL in channels:
+        channels = {ALL}
+    if ALL in channels or ALL in ws.channels:
+        unsubscribe(ws, set(ws.channels))
+    channels = set(channels) - ws.channels
+    for channel in channels:
+        subscribers.setdefault(channel, set()).add(ws)
+    ws.channels |= channels
+    return channels
+
+
+def unsubscribe(ws, channels):
+    """Make a spectator stop following some channels."""
+    for channel in ws.channels & set(channels):
+        followers = subscribers[channel]
+        followers.discard(ws)
+        if not followers and channel != ALL:
+            del subscribers[channel]
+    ws.channels -= set(channels)
+
+
+def forget(ws):
+    """Stop sending anything to a spectator."""
+    liveWebSockets.discard(ws)
+    unsubscribe(ws, set(ws.channels))
 
 
 class MainHandler(web.RequestHandler):
@@ -34,39 +368,48 @@ class BasicProtectedHandler(web.RequestHandler):
 class PostHandler(BasicProtectedHandler):
     def post(self):
         data = self.get_body_argument('data')
-        server.add_callback(webSocketSendMessage, self._build_message(data))
+        self.payload = json.loads(data)
+        receive(self._build_action(), data, self.payload,
+                self.payload.get('piste'),
+                self.payload.get('id_course'),
+                self.payload.get('sequence'))
         self.set_status(200)
         self.finish()
 
 
 class SetupHandler(PostHandler):
-    def _build_message(self, data):
-        global last_race_setup
-        last_race_setup = '{"action": "setup", ' + data[1:]
-        return last_race_setup
+    def _build_action(self):
+        return 'setup'
 
 
 class WarmupHandler(PostHandler):
-    def _build_message(self, data):
-        return '{"action": "warmup", ' + data[1:]
+    def _build_action(self):
+        return 'warmup'
 
 
 class UpdateHandler(PostHandler):
-    def _build_message(self, data):
-        return '{"action": "update", ' + data[1:]
+    def _build_action(self):
+        # Batches of updates hold their drones in an array
+        if 'drones' in self.payload:
+            return 'updates'
+        return 'update'
 
 
 class LeaderBoardHandler(PostHandler):
-    def _build_message(self, data):
-        return '{"action": "leaderboard", ' + data[1:]
+    def _build_action(self):
+        return 'leaderboard'
 
 
 class GetHandler(BasicProtectedHandler):
     def get(self):
-        global last_race_setup
-        last_race_setup = None
-        data={'action': self._build_action()}
-        server.add_callback(webSocketSendMessage, data)
+        race = self.get_query_argument('id_course', None)
+        sequence = self.get_query_argument('sequence', None)
+        track = self.get_query_argument('piste', None)
+        # Browsers need the track to know which race is over
+        payload = {} if track is None else {'piste': track}
+        receive(self._build_action(), json.dumps(payload), payload, track,
+                race and int(race),
+                sequence and int(sequence))
         self.set_status(200)
         self.finish()
 
@@ -82,35 +425,232 @@ class FinishHandler(GetHandler):
 
 
 class DefaultWebSocket(websocket.WebSocketHandler):
+    # Messages waiting for the previous ones to be sent, if any
+    backlog = None
+    # Names of the channels followed
+    channels = frozenset()
+
+    def get_compression_options(self):
+        # Messages are compressed once for all connections, see build_frame
+        return {} if Settings.compression else None
+
     def open(self):
         print("WebSocket opened")
         self.set_nodelay(True)
         liveWebSockets.add(self)
-        if last_race_setup:
-            self.write_message(last_race_setup)
+        self.channels = set()
+        channels = self.get_query_argument('channels', ALL)
+        subscribe(self, set(channels.split(',')))
+        seen = self.get_query_argument('seq', None)
+        if seen is None or not seen.isdigit():
+            send_snapshots(self, self.channels)
+        else:
+            resume(self, int(seen))
 
     def on_message(self, message):
-        print('Message incomming:', message)
+        # Subscriptions are changed with {"subscribe": [channels...]} or
+        # {"unsubscribe": [channels...]} messages
+        try:
+            request = json.loads(message)
+            unfollowed = {str(channel)
+                          for channel in request.get('unsubscribe', ())}
+            followed = {str(channel)
+                        for channel in request.get('subscribe', ())}
+        except (ValueError, AttributeError, TypeError):
+            print('Message incomming:', message)
+            return
+        unsubscribe(self, unfollowed)
+        send_snapshots(self, subscribe(self, followed))
 
     def on_close(self):
-        liveWebSockets.remove(self)
+        forget(self)
         print("WebSocket closed")
 
 
-def webSocketSendMessage(message):
-    removable = set()
-    for ws in liveWebSockets:
-        if not ws.ws_connection or not ws.ws_connection.stream.socket:
-            removable.add(ws)
-        else:
-            ws.write_message(message)
-    for ws in removable:
-        liveWebSockets.remove(ws)
+def resume(ws, seen):
+    """Bring a reconnecting spectator up to date: replay the messages it
+    missed if they are all still in the history, or send it a snapshot
+    of the race otherwise.
+
+    Parameters:
+      - ws: the WebSocketHandler of the spectator
+      - seen: sequence number of the last message it received
+    """
+    if seen == last_sequence:
+        return
+    if history and history[0].sequence <= seen + 1 and seen < last_sequence:
+        followed = ws.channels
+        for message in history:
+            if message.sequence > seen and (
+                    ALL in followed or message.channel in followed):
+                _send(ws, message)
+    else:
+        send_snapshots(ws, ws.channels, force=True)
+
+
+def receive(action, data, payload, track, race, sequence):
+    """Broadcast a message received from a console, unless it is
+    outdated. When serving with several processes, the message is handed
+    to the hub instead, which broadcasts it through every process.
+
+    Parameters:
+      - action: kind of message
+      - data: JSON text of the object sent along the action, if any
+      - payload: the object sent along the action, if any
+      - track: name of the track the race takes place on
+      - race: identification of the race
+      - sequence: number of the message among the ones about the race
+    """
+    if hub is not None:
+        hub.send([action, data, track, race, sequence])
+    elif in_sequence(track, race, sequence):
+        broadcast(action, data, payload, track)
+
+
+def broadcast(action, data=None, payload=None, channel=None):
+    """Send a message to the spectators following a channel. Can be
+    called from any thread.
+
+    Parameters:
+      - action: kind of message, telling the browsers how to handle it
+      - data: JSON text of the object sent along the action, if any
+      - payload: the object sent along the action, if already decoded;
+        it must not be modified afterwards
+      - channel: name of the channel, usually the track the race takes
+        place on
+    """
+    server.add_callback(_broadcast, action, data, payload, channel)
+
+
+def _broadcast(action, data, payload, channel=None, sequence=None):
+    """Build a message and send it to the spectators following its
+    channel. Runs in the thread of the IOLoop.
+
+    Parameter:
+      - sequence: number of the message, when given by the hub
+    """
+    global last_sequence
+    last_sequence = last_sequence + 1 if sequence is None else sequence
+    if payload is None:
+        payload = {} if data is None else json.loads(data)
+    if action in ('update', 'updates'):
+        # Only send the fields that changed since the last status of
+        # each drone; browsers apply them as 'deltas'
+        drones = payload['drones'] if action == 'updates' else [payload]
+        delta = {key: payload[key]
+                 for key in ('piste', 'id_course') if key in payload}
+        delta['drones'] = race_state(channel).changes(drones)
+        message = Message(last_sequence, 'deltas', delta, channel=channel)
+    else:
+        if action in BARE_ACTIONS:
+            # Only tell which track the race was on, which the hub only
+            # hands along as the channel
+            track = payload.get('piste', channel)
+            data = json.dumps({} if track is None else {'piste': track})
+        elif data is None:
+            data = json.dumps(payload)
+        encoded = '{"action": "%s", "seq": %d%s' % (
+                action, last_sequence,
+                data[1:] if data == '{}' else ', ' + data[1:])
+        message = Message(last_sequence, action, payload,
+                          encoded.encode('utf-8'), channel)
+    race_state(channel).apply(action, payload)
+    history.append(message)
+    sockets = chain(subscribers.get(channel, ()), subscribers[ALL])
+    for ws in [ws for ws in sockets if not _send(ws, message)]:
+        forget(ws)
+
+
+def build_frame(payload, wbits=None):
+    """Build a complete text frame holding a message, as sent by a server
+    (thus unmasked), so that the same bytes can be written to every
+    connection.
+
+    Parameters:
+      - payload: UTF-8 encoded message
+      - wbits: size of the compression window negotiated with the
+        clients, or None to send the message uncompressed
+    """
+    flags = 0x81  # FIN + text opcode
+    if wbits is not None:
+        compressor = compressors.get(wbits)
+        if compressor is None:
+            compressor = compressors[wbits] = zlib.compressobj(
+                    6, zlib.DEFLATED, -wbits)
+        # A full flush makes the message independent of the previous ones,
+        # whatever the context takeover agreed with each client
+        payload = compressor.compress(payload)
+        payload = (payload + compressor.flush(zlib.Z_FULL_FLUSH))[:-4]
+        flags |= 0x40  # RSV1: compressed message
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('BB', flags, length)
+    elif length <= 0xFFFF:
+        header = struct.pack('!BBH', flags, 126, length)
+    else:
+        header = struct.pack('!BBQ', flags, 127, length)
+    return header + payload
+
+
+def _send(ws, message):
+    """Write a Message to a spectator, or queue it if the spectator did
+    not read the previous ones yet. Spectators not reading anything for
+    Settings.lag seconds are disconnected.
+
+    Return False if the connection is closed.
+    """
+    backlog = ws.backlog
+    if backlog is None:
+        return _write(ws, message.encoded, message.frames)
+    if monotonic() - backlog.since > Settings.lag:
+        print('WebSocket lagging behind, closed')
+        ws.ws_connection.stream.close()
+        return False
+    backlog.append(message)
+    return True
+
+
+def _write(ws, payload, frames):
+    """Write a message to a connection, building its frame if it is the
+    first connection of its kind to receive it. Tornado buffers anything
+    the connection can not take right away: the next messages are then
+    queued in a Backlog until the buffer is flushed, bounding the memory
+    used by slow spectators.
+
+    Parameters:
+      - ws: the WebSocketHandler to write to
+      - payload: UTF-8 encoded message
+      - frames: cache of the frames already built for this message
+
+    Return False if the connection is closed.
+    """
+    connection = ws.ws_connection
+    if not connection or not connection.stream.socket:
+        return False
+    compressor = getattr(connection, '_compressor', None)
+    wbits = compressor and compressor._max_wbits
+    frame = frames.get(wbits)
+    if frame is None:
+        frame = frames[wbits] = build_frame(payload, wbits)
+    try:
+        written = connection.stream.write(frame)
+    except StreamClosedError:
+        return False
+    if ws.backlog is None and connection.stream.writing():
+        ws.backlog = Backlog()
+        written.add_done_callback(lambda future: _drain(ws))
+    return True
 
 
-def serve_forever():
-    global server
-    application = web.Application(
+def _drain(ws):
+    """Write the backlog of a spectator once it caught up."""
+    backlog, ws.backlog = ws.backlog, None
+    if ws in liveWebSockets and not backlog.flush(ws):
+        forget(ws)
+
+
+def make_application():
+    return web.Application(
         [
             (r"/", MainHandler),
             (r"/setup/", SetupHandler),
@@ -130,9 +670,142 @@ def serve_forever():
         static_path=Settings.static,
         debug=Settings.debug,
     )
-    application.listen(Settings.port)
-    print('Server listening on port', Settings.port)
-    server = ioloop.IOLoop.instance()
+
+
+def start_in_thread(port=None):
+    """Run the server in the background, on its own IOLoop, so that it
+    can be fed directly through `broadcast` by the process starting it.
+
+    Parameter:
+      - port: the port to listen on; defaults to Settings.port
+
+    Return the IOLoop of the server.
+    """
+    port = Settings.port if port is None else port
+    # Bind now so that errors are raised in the calling thread
+    sockets = netutil.bind_sockets(port)
+    started = threading.Event()
+
+    def run():
+        global server
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        server = ioloop.IOLoop.current()
+        httpserver.HTTPServer(make_application()).add_sockets(sockets)
+        started.set()
+        server.start()
+
+    thread = threading.Thread(target=run, name='spectators', daemon=True)
+    thread.start()
+    started.wait()
+    print('Server listening on port', port)
+    return server
+
+
+def stop():
+    """Stop a server started by `start_in_thread`."""
+    if server is not None:
+        server.add_callback(server.stop)
+
+
+class Hub(tcpserver.TCPServer):
+    """Process gathering the messages received by every worker process
+    and broadcasting them, numbered, to all of them.
+
+    Messages go through a Unix-domain socket as lines of JSON: workers
+    send [action, data, track, race, sequence] lists, the hub answers
+    with [number, action, data, channel] lists.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.workers = set()
+
+    async def handle_stream(self, stream, address):
+        self.workers.add(stream)
+        try:
+            while True:
+                line = await stream.read_until(b'\n')
+                action, data, track, race, sequence = json.loads(line)
+                if in_sequence(track, race, sequence):
+                    self.publish(action, data, track)
+        except StreamClosedError:
+            pass
+        finally:
+            self.workers.discard(stream)
+
+    def publish(self, action, data, channel):
+        """Send a message to every worker."""
+        global last_sequence
+        last_sequence += 1
+        line = json.dumps(
+                [last_sequence, action, data, channel]).encode('utf-8')
+        for stream in list(self.workers):
+            try:
+                stream.write(line + b'\n')
+            except StreamClosedError:
+                self.workers.discard(stream)
+
+
+class HubClient:
+    """Connection of a worker process to the hub."""
+
+    def __init__(self, path):
+        """Parameter:
+          - path: the Unix-domain socket the hub listens on
+        """
+        self.path = path
+        self.stream = None
+
+    def send(self, message):
+        """Hand a message received from a console to the hub."""
+        line = json.dumps(message).encode('utf-8') + b'\n'
+        try:
+            self.stream.write(line)
+        except (AttributeError, StreamClosedError):
+            print('Hub unreachable, message dropped:', message[0])
+
+    async def follow(self):
+        """Broadcast the messages of the hub, reconnecting to it if it
+        is restarted.
+        """
+        while True:
+            try:
+                self.stream = IOStream(
+                        socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+                await self.stream.connect(self.path)
+                while True:
+                    line = await self.stream.read_until(b'\n')
+                    sequence, action, data, channel = json.loads(line)
+                    _broadcast(action, data, None, channel, sequence)
+            except (OSError, StreamClosedError):
+                self.stream = None
+                await asyncio.sleep(1)
+
+
+def serve_forever():
+    global server, hub
+    workers = Settings.workers or process.cpu_count()
+    if workers > 1:
+        # Sockets are bound before forking so that every worker accepts
+        # spectators on the same port and finds the hub listening
+        sockets = netutil.bind_sockets(Settings.port)
+        listener = netutil.bind_unix_socket(Settings.hub)
+        print('Server listening on port', Settings.port,
+              'with', workers, 'processes')
+        # Process 0 is the hub, the other ones serve the spectators
+        if process.fork_processes(workers + 1) == 0:
+            for sock in sockets:
+                sock.close()
+            Hub().add_socket(listener)
+        else:
+            listener.close()
+            hub = HubClient(Settings.hub)
+            httpserver.HTTPServer(make_application()).add_sockets(sockets)
+            ioloop.IOLoop.current().add_callback(hub.follow)
+    else:
+        make_application().listen(Settings.port)
+        print('Server listening on port', Settings.port)
+    server = ioloop.IOLoop.current()
     try:
         server.start()
     except KeyboardInterrupt: